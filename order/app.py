@@ -5,21 +5,32 @@ import os
 import shutil
 import uuid
 from http import HTTPStatus
+from typing import Optional, Set
 
-from flask_sqlalchemy import SQLAlchemy
 from prometheus_async.aio import time
 from prometheus_client import (
     CONTENT_TYPE_LATEST,
-    Histogram,
+    Counter, Gauge, Histogram,
     generate_latest, CollectorRegistry, multiprocess,
 )
-from quart import Quart, make_response, jsonify, Response
-from sqlalchemy.dialects.postgresql import ARRAY
+from quart import Quart, abort, make_response, jsonify, request, Response
+from sqlalchemy import Column, Integer, case, cast, delete, extract, func, literal, select, update
+from sqlalchemy.dialects.postgresql import JSONB, insert
 from sqlalchemy.exc import ProgrammingError
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.types import String, Float, Boolean
 
-from producer import Producer, OrderConnection
+from cache import OrderCache, PriceCache
+from codec import MESSAGE_CODEC, codec_by_name
+from database import (
+    Base, Session, create_tables, drop_tables, get_or_404, id_series, instrument_pool, mark_written, read_or_404,
+    sample_pools, sticky_reads,
+)
+from outbox import OutboxRelay, add_message
+from producer import OrderConnection, Producer, RpcClient, RpcMetrics, RpcUnavailable
+from saga import (
+    SAGA_RECOVERY_INTERVAL, Saga, SagaStatus, claim_stuck_sagas, latest_saga, start_saga, transition,
+)
 
 app_name = 'order-service'
 app = Quart(app_name)
@@ -32,17 +43,6 @@ logger = logging.getLogger(app_name)
 stock_url = f'http://{os.environ["STOCK_SERVICE_URL"]}'
 payment_url = f'http://{os.environ["PAYMENT_SERVICE_URL"]}'
 
-DB_URL = 'postgresql+psycopg2://{user}:{pw}@{host}/{db}' \
-    .format(user=os.environ['POSTGRES_USER'],
-            pw=os.environ['POSTGRES_PASSWORD'],
-            host=os.environ['POSTGRES_HOST'],
-            db=os.environ['POSTGRES_DB'])
-
-app.config['SQLALCHEMY_DATABASE_URI'] = DB_URL
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # silence the deprecation warning
-
-db = SQLAlchemy(app, session_options={"expire_on_commit": False})
-
 PROMETHEUS_MULTIPROC_DIR = os.environ["PROMETHEUS_MULTIPROC_DIR"]
 # make sure the dir is clean
 shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
@@ -50,6 +50,8 @@ os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
 
 registry = CollectorRegistry()
 multiprocess.MultiProcessCollector(registry)
+instrument_pool()
+sticky_reads(app)
 
 create_order_metric = Histogram("create_order", "Histogram of /create/<user_id> endpoint")
 remove_order_metric = Histogram("remove_order", "Histogram of /remove/<order_id>")
@@ -57,33 +59,95 @@ remove_item_metric = Histogram("remove_item", "Histogram of '/removeItem/<order_
 add_item_metric = Histogram("add_item", "Histogram of /removeItem/<order_id>/<item_id>")
 find_order_metric = Histogram("find_order", "Histogram of /find/<order_id>")
 checkout_metric = Histogram("checkout", "Histogram of /checkout/<order_id>")
+checkout_status_metric = Histogram("checkout_status", "Histogram of /checkout_status/<order_id>")
 handle_rollback_metric = Histogram("handle_rollback", "Histogram of handle rollback")
 check_producer_metric = Histogram("check_producer", "Histogram of check producer func")
 publish_checkout_metric = Histogram("publish_checkout", "Histogram of publish checkout")
 publish_stock_metric = Histogram("publish_stock", "Histogram of publish checkout")
 publish_payment_metric = Histogram("publish_payment", "Histogram of publish checkout")
+fetch_prices_metric = Histogram("fetch_prices", "Histogram of batched price lookups")
+saga_recovered_metric = Counter("saga_recovered", "Sagas finished by the recovery worker", ["status"])
+batch_init_metric = Histogram("batch_init", "Histogram of /batch_init/<n>/<n_items>/<n_users>/<item_price>")
+order_cache_hits_metric = Counter("order_cache_hits", "Order cache hits", ["tier"])
+order_cache_misses_metric = Counter("order_cache_misses", "Order cache misses", ["tier"])
+outbox_relayed_metric = Counter("outbox_relayed", "Messages published from the outbox")
+
+rpc_metrics = RpcMetrics(
+    timeouts=Counter("rpc_timeouts", "RPCs that got no reply in time", ["queue"]),
+    rejected=Counter("rpc_rejected", "RPCs rejected without sending them", ["queue", "reason"]),
+    open_circuits=Gauge("rpc_circuit_open", "Processes with an open circuit to a queue", ["queue"],
+                        multiprocess_mode='livesum'),
+    in_flight=Gauge("rpc_in_flight", "RPCs waiting for a reply", multiprocess_mode='livesum'),
+)
 
 # Create connection and producer objects.
 connection = OrderConnection()
-stock_producer = Producer("stock")
-payment_producer = Producer("payment")
+# RPCs waiting for a reply at the same time, more are rejected with 503 instead of queueing up in memory
+RPC_MAX_IN_FLIGHT = int(os.environ.get('RPC_MAX_IN_FLIGHT', 1000))
+# Consecutive failed RPCs to a queue that open its circuit, rejecting RPCs to it for CIRCUIT_RESET_TIMEOUT seconds
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 5))
+# Comma separated queues whose consumers are partitioned by entity ID (CONSUMER_PARTITION), e.g. "stock,payment"
+PARTITIONED_QUEUES = [queue for queue in os.environ.get('PARTITIONED_QUEUES', '').split(',') if queue]
+rpc_client = RpcClient(RPC_MAX_IN_FLIGHT, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, rpc_metrics,
+                       PARTITIONED_QUEUES, codec_by_name(MESSAGE_CODEC))
+stock_producer = Producer(rpc_client, "stock")
+payment_producer = Producer(rpc_client, "payment")
+# Publishes the compensations and commits of checkouts, written to the outbox with the saga status
+outbox_relay = OutboxRelay(rpc_client, lambda: check_producer(), outbox_relayed_metric)
+
+# Seconds to wait for a reply of the stock or payment service
+RPC_TIMEOUT = float(os.environ.get('RPC_TIMEOUT', 30))
+# Reply 202 to a checkout and run it in the background, can be overridden per request with ?async=true or false
+CHECKOUT_ASYNC = os.environ.get('CHECKOUT_ASYNC', 'false').lower() == 'true'
+# Reserve the stock of a checkout and commit or release the reservation, instead of subtracting it and adding it back
+STOCK_RESERVATIONS = os.environ.get('STOCK_RESERVATIONS', 'false').lower() == 'true'
+# Seconds the stock service holds a reservation before it expires. A checkout only decides to commit its reservation
+# in the first half, the second half is left for the commit to reach the stock service.
+RESERVATION_TTL = float(os.environ.get('RESERVATION_TTL', 600))
+# Protocol of new checkouts: 'saga' pays and subtracts the stock and compensates the steps that succeeded if the other
+# failed, '2pc' prepares the payment and reserves the stock, then commits or aborts both once the outcome is logged
+CHECKOUT_PROTOCOL = os.environ.get('CHECKOUT_PROTOCOL', 'saga').lower()
+if CHECKOUT_PROTOCOL not in ('saga', '2pc'):
+    raise ValueError(f"Unknown checkout protocol {CHECKOUT_PROTOCOL}, expected saga or 2pc")
+
+
+@time(fetch_prices_metric)
+async def fetch_prices(item_ids):
+    """
+    Get the prices of a batch of items from the stock service in one message.
+    :param item_ids: IDs of items
+    :return: dictionary of prices by item ID, items that do not exist are left out
+    """
+    await check_producer()
+    response = await stock_producer.publish({"item_ids": item_ids}, "getPrices", reply=True, timeout=RPC_TIMEOUT)
+    return response['message']['prices']
+
 
+# Prices do not change after an item is created, so they can be cached for a long time.
+price_cache = PriceCache(fetch_prices,
+                         max_size=int(os.environ.get('PRICE_CACHE_SIZE', 100_000)),
+                         ttl=float(os.environ.get('PRICE_CACHE_TTL', 300)),
+                         linger=float(os.environ.get('PRICE_BATCH_LINGER', 0.002)),
+                         max_batch=int(os.environ.get('PRICE_BATCH_SIZE', 500)))
 
-class Order(db.Model):
+
+class Order(Base):
     __tablename__ = 'orders'
 
-    id = db.Column(String, primary_key=True)
-    paid = db.Column(Boolean, unique=False, nullable=False)
-    user_id = db.Column(String, unique=False, nullable=False)
-    items = db.Column(ARRAY(String, dimensions=1), unique=False, nullable=True)
-    total_cost = db.Column(Float, unique=False, nullable=False)
+    id = Column(String, primary_key=True)
+    paid = Column(Boolean, unique=False, nullable=False)
+    user_id = Column(String, unique=False, nullable=False)
+    # Quantity by item ID
+    items = Column(JSONB, unique=False, nullable=False)
+    total_cost = Column(Float, unique=False, nullable=False)
 
     def __init__(self, id, paid, items, user_id, total_cost):
         """
         Order object containing all relevant fields.
         :param id: ID of order
         :param paid: indicating if order is paid
-        :param items: item IDs of order
+        :param items: quantities of the items of order by item ID
         :param user_id: ID of user this order belongs to
         :param total_cost: total cost of order
         """
@@ -110,29 +174,65 @@ class Order(db.Model):
         return dct
 
 
-# Create all needed tables in database.
-db.create_all()
-db.session.commit()
+async def load_order(order_id):
+    """
+    Load an order from the primary database for the order cache.
+    :param order_id: ID of order
+    :return: order as dictionary, None if it does not exist
+    """
+    async with Session() as session:
+        order = await session.get(Order, order_id)
+    return None if order is None else order.as_dict()
+
+
+# Both tiers are disabled by default, every read then goes to the database.
+order_cache = OrderCache(load_order,
+                         local_size=int(os.environ.get('ORDER_CACHE_SIZE', 0)),
+                         local_ttl=float(os.environ.get('ORDER_CACHE_TTL', 1)),
+                         redis_url=os.environ.get('ORDER_CACHE_REDIS_URL', ''),
+                         redis_ttl=float(os.environ.get('ORDER_CACHE_REDIS_TTL', 60)),
+                         hits=order_cache_hits_metric,
+                         misses=order_cache_misses_metric,
+                         redis_lease=float(os.environ.get('ORDER_CACHE_REDIS_LEASE', 5)))
+
 
+saga_recovery: Optional[asyncio.Task] = None
+outbox_relay_task: Optional[asyncio.Task] = None
 
-def recreate_tables():
+
+@app.before_serving
+async def startup():
+    """
+    Create all needed tables in database, and start recovering the sagas of crashed checkouts
+    and relaying the outbox.
+    """
+    global saga_recovery, outbox_relay_task
+    await create_tables()
+    saga_recovery = asyncio.create_task(recover_sagas())
+    outbox_relay_task = asyncio.create_task(outbox_relay.run())
+
+
+@app.after_serving
+async def shutdown():
+    if saga_recovery is not None:
+        saga_recovery.cancel()
+    if outbox_relay_task is not None:
+        outbox_relay_task.cancel()
+
+
+async def recreate_tables():
     """
     Recreate all tables in the database.
     """
     logger.debug("DB drop all")
     try:
-        db.session.close()
-        db.drop_all()
+        await drop_tables()
     except ProgrammingError:
         logger.warning("Not dropping table as it does not exist")
     logger.debug("DB dropped all")
     logger.debug("DB create all")
-    db.create_all()
+    await create_tables()
     logger.debug("DB created all")
-    logger.debug("DB commit")
-    db.session.commit()
-    logger.debug("DB commited")
-    db.session.close()
 
 
 @app.post('/create/<user_id>')
@@ -144,15 +244,61 @@ async def create_order(user_id):
     :return: the created order's ID
     """
     order_id = str(uuid.uuid4())
-    order = Order(order_id, False, [], user_id, 0)
+    order = Order(order_id, False, {}, user_id, 0)
 
-    db.session.add(order)
-    db.session.commit()
-    db.session.close()
+    async with Session() as session:
+        session.add(order)
+        await session.commit()
+    mark_written()
 
     return await make_response(jsonify({"order_id": order_id}), HTTPStatus.OK)
 
 
+@app.post('/batch_init/<n>/<n_items>/<n_users>/<item_price>')
+@time(batch_init_metric)
+async def batch_init(n: int, n_items: int, n_users: int, item_price: float):
+    """
+    Create n unpaid orders with IDs 0 to n - 1 in a single statement, orders that already exist are reset.
+    Order i belongs to user i % n_users and contains the items i % n_items and (i + 1) % n_items,
+    matching the IDs created by the batch_init endpoints of the payment and stock service.
+    :param n: number of orders
+    :param n_items: number of items to choose from
+    :param n_users: number of users to choose from
+    :param item_price: price of every item
+    :return: number of orders, 400 if there are no items or users to choose from
+    """
+    n, n_items, n_users = int(n), int(n_items), int(n_users)
+    if n_items < 1 or n_users < 1:
+        return await make_response("n_items and n_users must be at least 1", HTTPStatus.BAD_REQUEST)
+    i = id_series(n)
+    one = cast(literal(1), Integer)
+    if n_items == 1:
+        items = func.jsonb_build_object(cast(literal('0'), String), cast(literal(2), Integer))
+    else:
+        items = func.jsonb_build_object(cast(i % n_items, String), one, cast((i + 1) % n_items, String), one)
+    statement = insert(Order).from_select(
+        ['id', 'paid', 'items', 'user_id', 'total_cost'],
+        select(
+            cast(i, String),
+            cast(literal(False), Boolean),
+            items,
+            cast(i % n_users, String),
+            cast(literal(2 * float(item_price)), Float)
+        )
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[Order.id],
+        set_={column: statement.excluded[column] for column in ('paid', 'items', 'user_id', 'total_cost')}
+    )
+
+    async with Session() as session:
+        await session.execute(statement)
+        await session.commit()
+    await order_cache.clear()
+
+    return await make_response(jsonify({"msg": "Batch init for orders successful", "n": n}), HTTPStatus.OK)
+
+
 @app.delete('/remove/<order_id>')
 @time(remove_order_metric)
 async def remove_order(order_id):
@@ -161,10 +307,11 @@ async def remove_order(order_id):
     :param order_id: order ID to delete
     :return: response indicating success of deletion
     """
-    Order.query.filter_by(id=order_id).delete()
-
-    db.session.commit()
-    db.session.close()
+    async with Session() as session:
+        await session.execute(delete(Order).where(Order.id == order_id))
+        await session.commit()
+    mark_written()
+    await order_cache.invalidate(order_id)
 
     return await make_response('success', HTTPStatus.OK)
 
@@ -179,26 +326,25 @@ async def add_item(order_id, item_id):
     :return: response indicating success of adding item
     """
     logger.debug(f"Adding item to {order_id = }, {item_id =}")
-    order = Order.query.get_or_404(order_id)
-    logger.debug(f"before {order.items = }")
-
-    # Add item to order.items list
-    order.items.append(item_id)
-    flag_modified(order, "items")
-
-    # Increase total cost of order
-    await check_producer()
-    body = json.dumps({"item_id": item_id})
-    response = await stock_producer.publish(body, "getPrice", reply=True)
-    order.total_cost += json.loads(response['message'])['price']
-    flag_modified(order, "total_cost")
-
-    logger.debug(f"Added item to {order_id = }, {item_id =}, {order.items = }")
-
-    db.session.merge(order)
-    db.session.flush()
-    db.session.commit()
-    db.session.close()
+    price = await price_cache.get(item_id)
+    if price is None:
+        return await make_response("Item not found", HTTPStatus.NOT_FOUND)
+
+    # Increase the quantity of the item and the total cost in place
+    key = cast(literal(item_id), String)
+    quantity = func.coalesce(Order.items[item_id].astext.cast(Integer), 0)
+    async with Session() as session:
+        result = await session.execute(
+            update(Order).where(Order.id == order_id).values(
+                items=Order.items.op('||')(func.jsonb_build_object(key, quantity + 1)),
+                total_cost=Order.total_cost + price
+            ).execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            abort(HTTPStatus.NOT_FOUND)
+        await session.commit()
+    mark_written()
+    await order_cache.invalidate(order_id)
 
     return await make_response("Item added to order", HTTPStatus.OK)
 
@@ -212,22 +358,29 @@ async def remove_item(order_id, item_id):
     :param item_id: ID of item to remove from order
     :return: response indicating success of adding item
     """
-    order = Order.query.get_or_404(order_id)
-
-    # Remove item from order.items list
-    order.items.remove(item_id)
-    flag_modified(order, "items")
-
-    # Decrease total cost of order
-    await check_producer()
-    body = json.dumps({"item_id": item_id})
-    response = await stock_producer.publish(body, "getPrice", reply=True)
-    order.total_cost -= json.loads(response['message'])['price']
-    flag_modified(order, "total_cost")
-
-    db.session.add(order)
-    db.session.commit()
-    db.session.close()
+    price = await price_cache.get(item_id)
+    if price is None:
+        return await make_response("Item not found", HTTPStatus.NOT_FOUND)
+
+    # Decrease the quantity of the item in place, dropping it from the order at 0, and decrease the total cost
+    key = cast(literal(item_id), String)
+    quantity = Order.items[item_id].astext.cast(Integer)
+    async with Session() as session:
+        result = await session.execute(
+            update(Order).where(Order.id == order_id, Order.items.has_key(item_id)).values(
+                items=case(
+                    (quantity <= 1, Order.items.op('-')(key)),
+                    else_=Order.items.op('||')(func.jsonb_build_object(key, quantity - 1))
+                ),
+                total_cost=Order.total_cost - price
+            ).execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            await get_or_404(session, Order, order_id)
+            return await make_response("Item not in order", HTTPStatus.NOT_FOUND)
+        await session.commit()
+    mark_written()
+    await order_cache.invalidate(order_id)
 
     return await make_response("Item removed from order", HTTPStatus.OK)
 
@@ -240,17 +393,66 @@ async def find_order(order_id):
     :param order_id: ID of order to find
     :return: object containing order: Order { order_id, paid, items, user_id, total_cost }
     """
-    return Order.query.get_or_404(order_id).as_dict()
+    if not order_cache.enabled:
+        order = (await read_or_404(Order, order_id)).as_dict()
+    else:
+        order = await order_cache.get(order_id)
+        if order is None:
+            abort(HTTPStatus.NOT_FOUND)
+
+    # The API lists an item once per unit
+    return {**order, "items": [item_id for item_id, quantity in order["items"].items() for _ in range(quantity)]}
+
+
+def saga_message_id(order_id, checkout_id, task):
+    """
+    Create the ID of a message of a checkout, the consumers only process a message with the same ID once.
+    :param order_id: ID of order being checked out
+    :param checkout_id: ID of this checkout attempt of the order
+    :param task: task of the message
+    :return: ID of message
+    """
+    return f"{order_id}/{checkout_id}/{task}"
+
+
+def payment_partition_key(payment_body: dict) -> str:
+    """
+    Get the key routing a payment message to the consumer owning its user.
+    """
+    return payment_body["user_id"]
+
+
+def is_two_phase(payment_body: dict) -> bool:
+    """
+    Check if a checkout was started with the two-phase protocol, it keeps it when CHECKOUT_PROTOCOL is changed.
+    """
+    return "transaction_id" in payment_body
+
+
+def stock_partition_key(stock_body: dict) -> Optional[str]:
+    """
+    Get the key routing a stock message to a consumer, the lowest item ID so the same cart always goes to the
+    same consumer. Carts sharing only some items can still reach different consumers.
+    """
+    return min(stock_body["items"], default=None)
 
 
 @time(publish_checkout_metric)
-async def publish_checkout(payment_body, stock_body):
+async def publish_checkout(order_id, checkout_id, payment_body, stock_body):
     await check_producer()
-
-    payment_response, stock_response = await asyncio.gather(payment_producer.publish(payment_body, "pay", reply=True),
-                                                            stock_producer.publish(stock_body, "subtractItems",
-                                                                                   reply=True)
-                                                            )
+    payment_body, stock_body = json.loads(payment_body), json.loads(stock_body)
+    # Checkouts started with STOCK_RESERVATIONS keep reserving when it is turned off, and the other way around
+    stock_task = "reserve" if "reservation_id" in stock_body else "subtractItems"
+    payment_task = "prepare" if is_two_phase(payment_body) else "pay"
+
+    payment_response, stock_response = await asyncio.gather(
+        payment_producer.publish(payment_body, payment_task, reply=True, timeout=RPC_TIMEOUT,
+                                 message_id=saga_message_id(order_id, checkout_id, payment_task),
+                                 partition_key=payment_partition_key(payment_body)),
+        stock_producer.publish(stock_body, stock_task, reply=True, timeout=RPC_TIMEOUT,
+                               message_id=saga_message_id(order_id, checkout_id, stock_task),
+                               partition_key=stock_partition_key(stock_body))
+    )
     return payment_response, stock_response
 
 
@@ -263,38 +465,138 @@ async def checkout(order_id):
     Then we talk to the payment service to make the payment.
     If one of both fails, we do rollback the commit, and we return status code 400.
     Else we return 200.
+    In async mode the checkout runs in the background and we return status code 202 with the URL of its status.
     :param order_id: ID of order to checkout.
-    :return: response 200 if successful, 400 if something fails
+    :return: response 200 if successful, 400 if something fails, 202 if accepted in async mode
     """
     logger.debug(f"Checking out order {order_id}")
-    order: Order = Order.query.get_or_404(order_id)
+    # Read from the primary, the charged total and items have to match the order that is marked paid
+    async with Session() as session:
+        order = await session.get(Order, order_id)
+    if order is None:
+        abort(HTTPStatus.NOT_FOUND)
     logger.debug(f"Found order in checkout: {order.as_dict()}")
 
     if order.paid:
-        logger.debug(f"Order already paid")
-        return make_response("Order already paid", HTTPStatus.BAD_REQUEST)
+        logger.debug("Order already paid")
+        return await make_response("Order already paid", HTTPStatus.BAD_REQUEST)
 
     # Setup RabbitMQ producers for the stock and payment requests
 
     # Creating the body for the messages
     logger.info(f"order: {order.as_dict()}")
-    stock_body = json.dumps({"item_ids": order.items})
-    payment_body = json.dumps({"user_id": order.user_id, "order_id": order.id, "total_cost": order.total_cost})
+    checkout_id = str(uuid.uuid4())
+    stock_message = {"items": order.items}
+    payment_message = {"user_id": order.user_id, "order_id": order.id, "total_cost": order.total_cost}
+    # The reservation of the stock is the prepared state of the stock service in a two-phase checkout
+    if STOCK_RESERVATIONS or CHECKOUT_PROTOCOL == '2pc':
+        stock_message["reservation_id"] = checkout_id
+        stock_message["reservation_ttl"] = RESERVATION_TTL
+    if CHECKOUT_PROTOCOL == '2pc':
+        payment_message["transaction_id"] = checkout_id
+    stock_body, payment_body = json.dumps(stock_message), json.dumps(payment_message)
+
+    # Shed load before starting a saga that can not be sent now
+    if not payment_producer.is_available() or not stock_producer.is_available():
+        raise RpcUnavailable("Payment or stock service unavailable")
+
+    # Log the checkout before sending anything, so it is finished even if this process crashes
+    saga = await start_saga(checkout_id, order_id, payment_body, stock_body)
+    # The checkout writes to the stock and payment service as well, the client reads them from the primary
+    mark_written()
+
+    if request.args.get('async', str(CHECKOUT_ASYNC)).lower() == 'true':
+        task = asyncio.create_task(run_saga_in_background(saga))
+        checkout_tasks.add(task)
+        task.add_done_callback(checkout_tasks.discard)
+        # Relative to /orders/checkout/<order_id>, so it also resolves behind the gateway prefix
+        status_url = f"../checkout_status/{order_id}"
+        response = await make_response(jsonify({"checkout_id": checkout_id, "status_url": status_url}),
+                                       HTTPStatus.ACCEPTED)
+        response.headers['Location'] = status_url
+        return response
+
+    try:
+        return await run_saga(saga)
+    except asyncio.TimeoutError as e:
+        logger.warning(f"Checkout {checkout_id} of order {order_id} failed with {e!r}, leaving it to the saga recovery")
+        return await make_response("Checkout timed out", HTTPStatus.SERVICE_UNAVAILABLE)
+    except RpcUnavailable as e:
+        # Answered by the error handler, with the Retry-After of the open circuit
+        logger.warning(f"Checkout {checkout_id} of order {order_id} failed with {e!r}, leaving it to the saga recovery")
+        raise
+
+
+class CheckoutAborted(Exception):
+    """
+    Raised when a checkout whose steps succeeded can not be completed, e.g. because the order changed while it was
+    checked out. The checkout is then compensated.
+    """
+
+
+# Checkouts running in the background, the saga recovery finishes them if this process stops
+checkout_tasks: Set[asyncio.Task] = set()
+
+
+async def run_saga_in_background(saga: Saga):
+    """
+    Run the saga of an async checkout, its outcome is read with /checkout_status/<order_id>.
+    :param saga: saga of the checkout, in the started status
+    """
+    try:
+        async with app.app_context():
+            await run_saga(saga)
+    except (asyncio.TimeoutError, RpcUnavailable) as e:
+        logger.warning(f"Checkout {saga.id} of order {saga.order_id} failed with {e!r}, leaving it to saga recovery")
+    except Exception:
+        logger.exception(f"Checkout {saga.id} of order {saga.order_id} failed, leaving it to the saga recovery")
 
+
+@app.get('/checkout_status/<order_id>')
+@time(checkout_status_metric)
+async def checkout_status(order_id):
+    """
+    Get the status of the last checkout of an order.
+    :param order_id: ID of order
+    :return: object containing the checkout: { checkout_id, order_id, status, paid }, the status is one of
+        started, committing, compensating, completed or failed
+    """
+    saga = await latest_saga(order_id)
+    if saga is None:
+        abort(HTTPStatus.NOT_FOUND)
+    return {
+        "checkout_id": saga.id,
+        "order_id": saga.order_id,
+        "status": saga.status.value,
+        "paid": saga.status in (SagaStatus.COMMITTING, SagaStatus.COMPLETED),
+    }
+
+
+async def run_saga(saga: Saga):
+    """
+    Send the payment and stock task of a checkout and finish it, for a new checkout or a recovered one.
+    :param saga: saga of the checkout, in the started status
+    :return: response 200 if successful, 400 if something fails
+    """
     # Send the payment and stock task to the respective queues simultaneously
-    payment_response, stock_response = await publish_checkout(payment_body, stock_body)
+    payment_response, stock_response = await publish_checkout(saga.order_id, saga.id,
+                                                              saga.payment_body, saga.stock_body)
 
     # If one of the tasks fails, start a rollback
-    logger.debug(f"order id: {order_id}, payment response: {payment_response}")
-    logger.debug(f"order id: {order_id}, stock response: {stock_response}")
+    logger.debug(f"order id: {saga.order_id}, payment response: {payment_response}")
+    logger.debug(f"order id: {saga.order_id}, stock response: {stock_response}")
     if not status_code_is_success(int(payment_response["status"])) \
             or not status_code_is_success(int(stock_response["status"])):
-        return await handle_rollback(payment_body, stock_body,
-                                     payment_response, stock_response)
+        return await handle_rollback(saga, payment_response, stock_response)
 
-    logger.debug(f"order id: {order_id} Payment and stock successful")
+    logger.debug(f"order id: {saga.order_id} Payment and stock successful")
     # If success set Order status to 'paid'
-    await set_order_to_paid(order)
+    try:
+        if not await set_order_to_paid(saga, int(payment_response["status"]), int(stock_response["status"])):
+            # Finished by another process with the same replies
+            logger.debug(f"Saga {saga.id} was finished concurrently")
+    except CheckoutAborted as e:
+        return await make_response(str(e), HTTPStatus.BAD_REQUEST)
 
     return await make_response("Order successful", HTTPStatus.OK)
 
@@ -309,50 +611,207 @@ def status_code_is_success(status_code):
 
 
 @time(handle_rollback_metric)
-async def handle_rollback(payment_body, stock_body, payment_response, stock_response):
+async def handle_rollback(saga: Saga, payment_response, stock_response):
     """
     Handles rollback for SAGA pattern. Handles different cases of failure.
-    :param payment_body: body sent to payment service
-    :param stock_body: body sent to stock service
+    :param saga: saga of the checkout, in the started status
     :param payment_response: response from payment service
     :param stock_response: response from stock service
-    :return:
+    :return: response 400 with the messages of the failed steps
     """
+    # The compensations are written to the outbox in the transaction failing the saga
+    async with Session() as session:
+        if await transition(session, saga, SagaStatus.FAILED, payment_status=int(payment_response["status"]),
+                            stock_status=int(stock_response["status"])):
+            await add_compensations(session, saga)
+        await session.commit()
+    outbox_relay.wake()
+
     message = ""
     if not status_code_is_success(int(payment_response["status"])):
-        logger.debug(f"Payment response code not success, {message}. payment body {payment_body}")
-        # Rollback Stock subtraction if Payment fails and Stock subtraction was success
-        if status_code_is_success(int(stock_response["status"])):
-            logger.debug(
-                f"stock_response response code success, {message}, rolling back stock. payment_body:{payment_body}")
-            await stock_producer.publish(stock_body, "increaseItems", reply=False)
-
         message += payment_response["message"] + "\t\t"
-
     if not status_code_is_success(int(stock_response["status"])):
-        logger.debug(f"Stock response code not success, {message}. payment body {payment_body}")
-        # Rollback Payment if Stock subtraction fails and Payment was success
-        if status_code_is_success(int(payment_response["status"])):
-            logger.debug(
-                f"Payment response code not success, {message}, rolling back payment. payment_body: {payment_body}")
-            await payment_producer.publish(payment_body, "cancel", reply=False)
-
         message += stock_response["message"]
     return await make_response(message, HTTPStatus.BAD_REQUEST)
 
 
-async def set_order_to_paid(order):
+async def add_stock_message(session: AsyncSession, saga: Saga, task: str):
     """
-    Updating an order to be paid.
-    :param order: order object to be updated.
+    Write a message of a checkout to the stock service to the outbox.
+    :param session: session of the transaction moving the saga
+    :param saga: saga of the checkout
+    :param task: task of the message
     """
-    order.paid = True
+    stock_body = json.loads(saga.stock_body)
+    await add_message(session, "stock", task, stock_body, saga_message_id(saga.order_id, saga.id, task),
+                      stock_partition_key(stock_body))
+
 
-    db.session.add(order)
-    db.session.commit()
-    db.session.close()
+async def add_payment_message(session: AsyncSession, saga: Saga, task: str):
+    """
+    Write a message of a checkout to the payment service to the outbox.
+    :param session: session of the transaction moving the saga
+    :param saga: saga of the checkout
+    :param task: task of the message
+    """
+    payment_body = json.loads(saga.payment_body)
+    await add_message(session, "payment", task, payment_body, saga_message_id(saga.order_id, saga.id, task),
+                      payment_partition_key(payment_body))
 
-    logger.debug(f"order successful")
+
+async def add_compensations(session: AsyncSession, saga: Saga):
+    """
+    Undo the steps of a failed checkout that succeeded, by writing their compensations to the outbox.
+    :param session: session of the transaction failing the saga
+    :param saga: saga of the checkout, with the status codes of its steps
+    """
+    # Rollback Stock subtraction if Payment fails and Stock subtraction was success
+    if status_code_is_success(saga.stock_status):
+        logger.debug(f"Payment of order {saga.order_id} failed, rolling back stock")
+        # A reservation is only marked released, its stock is returned by the sweeper of the stock service
+        reserved = "reservation_id" in json.loads(saga.stock_body)
+        await add_stock_message(session, saga, "releaseReservation" if reserved else "increaseItems")
+
+    # Rollback Payment if Stock subtraction fails and Payment was success
+    if status_code_is_success(saga.payment_status):
+        logger.debug(f"Stock subtraction of order {saga.order_id} failed, rolling back payment")
+        await add_payment_message(session, saga, "abort" if is_two_phase(json.loads(saga.payment_body)) else "cancel")
+
+
+async def add_commits(session: AsyncSession, saga: Saga):
+    """
+    Finalize the reservation and the prepared payment of a successful checkout, by writing their commits to the
+    outbox. A checkout that subtracted the stock and paid directly has nothing to commit.
+    :param session: session of the transaction completing the saga
+    :param saga: saga of the checkout
+    """
+    if "reservation_id" in json.loads(saga.stock_body):
+        await add_stock_message(session, saga, "commitReservation")
+    if is_two_phase(json.loads(saga.payment_body)):
+        await add_payment_message(session, saga, "commit")
+
+
+async def compensate(saga: Saga):
+    """
+    Fail a saga that was compensating, a status only sagas logged before the outbox was introduced can be in.
+    :param saga: saga of the checkout, in the compensating status
+    """
+    async with Session() as session:
+        if await transition(session, saga, SagaStatus.FAILED):
+            await add_compensations(session, saga)
+        await session.commit()
+    outbox_relay.wake()
+
+
+async def abort_checkout(session: AsyncSession, saga: Saga, payment_status: int, stock_status: int):
+    """
+    Fail a checkout whose steps succeeded, writing the compensations of both steps to the outbox.
+    :param session: session of the transaction, it is committed
+    :param saga: saga of the checkout, in the started status
+    :param payment_status: status code of the reply of the payment service
+    :param stock_status: status code of the reply of the stock service
+    """
+    if await transition(session, saga, SagaStatus.FAILED, payment_status=payment_status, stock_status=stock_status):
+        await add_compensations(session, saga)
+    await session.commit()
+    outbox_relay.wake()
+
+
+async def set_order_to_paid(saga: Saga, payment_status: int, stock_status: int) -> bool:
+    """
+    Updating an order to be paid, in the same transaction as completing its saga and writing its commits to the outbox.
+    For a two-phase checkout this transaction is the decision to commit.
+    :param saga: saga of the checkout, in the started status
+    :param payment_status: status code of the reply of the payment service
+    :param stock_status: status code of the reply of the stock service
+    :return: whether this call completed the saga
+    :raises CheckoutAborted: if the order no longer has the charged items and total, or its reservation may expire
+        before the commit arrives, the saga is failed instead
+    """
+    stock_body = json.loads(saga.stock_body)
+    charged_items = stock_body["items"]
+    charged_cost = json.loads(saga.payment_body)["total_cost"]
+    async with Session() as session:
+        # Only commit a reservation that is held for at least as long again, see RESERVATION_TTL
+        if "reservation_ttl" in stock_body:
+            age = await session.scalar(
+                select(extract('epoch', func.now() - Saga.created_at)).where(Saga.id == saga.id)
+            )
+            if float(age) > stock_body["reservation_ttl"] / 2:
+                await abort_checkout(session, saga, payment_status, stock_status)
+                raise CheckoutAborted("Reservation expired during checkout")
+
+        # Only pay for the order that was charged, items added or removed during the checkout are not paid for
+        result = await session.execute(
+            update(Order)
+            .where(Order.id == saga.order_id, Order.items == charged_items, Order.total_cost == charged_cost)
+            .values(paid=True)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            await abort_checkout(session, saga, payment_status, stock_status)
+            raise CheckoutAborted("Order changed during checkout")
+        if not await transition(session, saga, SagaStatus.COMPLETED,
+                                payment_status=payment_status, stock_status=stock_status):
+            return False
+        await add_commits(session, saga)
+        await session.commit()
+    outbox_relay.wake()
+    mark_written()
+    await order_cache.invalidate(saga.order_id)
+
+    logger.debug("order successful")
+    return True
+
+
+async def commit_checkout(saga: Saga):
+    """
+    Complete a two-phase checkout that was committing, a status only sagas logged before the outbox was introduced
+    can be in.
+    :param saga: saga of the checkout, in the committing status
+    """
+    async with Session() as session:
+        if await transition(session, saga, SagaStatus.COMPLETED):
+            await add_commits(session, saga)
+        await session.commit()
+    outbox_relay.wake()
+
+
+async def recover_saga(saga: Saga):
+    """
+    Finish a saga that was interrupted, sending its steps or compensations again.
+    The consumers reply to a message they processed before with the same reply, so it is not applied twice.
+    :param saga: claimed saga
+    """
+    await check_producer()
+    if saga.status == SagaStatus.STARTED:
+        await run_saga(saga)
+    elif saga.status == SagaStatus.COMMITTING:
+        await commit_checkout(saga)
+    else:
+        await compensate(saga)
+    saga_recovered_metric.labels(saga.status.value).inc()
+    logger.info(f"Recovered saga {saga.id} of order {saga.order_id}: {saga.status.value}")
+
+
+async def recover_sagas():
+    """
+    Periodically finish the sagas that have not made progress for SAGA_RECOVERY_AFTER seconds,
+    e.g. because the process running them crashed.
+    """
+    while True:
+        try:
+            sagas = await claim_stuck_sagas()
+            if sagas:
+                logger.warning(f"Recovering {len(sagas)} stuck sagas")
+            async with app.app_context():
+                results = await asyncio.gather(*(recover_saga(saga) for saga in sagas), return_exceptions=True)
+            for saga, result in zip(sagas, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Recovering saga {saga.id} failed, retrying later: {result!r}")
+        except Exception:
+            logger.exception("Recovering sagas failed")
+        await asyncio.sleep(SAGA_RECOVERY_INTERVAL)
 
 
 @app.delete('/clear_tables')
@@ -361,16 +820,39 @@ async def clear_tables():
     Clear all database tables of this service.
     :return: 200 if database tables were cleared
     """
-    recreate_tables()
+    await recreate_tables()
+    price_cache.invalidate()
+    await order_cache.clear()
     return await make_response("tables cleared", HTTPStatus.OK)
 
 
+@app.errorhandler(RpcUnavailable)
+async def rpc_unavailable(error):
+    """
+    Reject a request that needs a service which is failing or overloaded.
+    :return: response 503, to be retried after the circuit reset timeout
+    """
+    response = await make_response(str(error), HTTPStatus.SERVICE_UNAVAILABLE)
+    response.headers['Retry-After'] = str(int(CIRCUIT_RESET_TIMEOUT))
+    return response
+
+
+@app.errorhandler(asyncio.TimeoutError)
+async def rpc_timeout(error):
+    """
+    Fail a request that waited longer than RPC_TIMEOUT for another service.
+    :return: response 504
+    """
+    return await make_response("Timed out waiting for another service", HTTPStatus.GATEWAY_TIMEOUT)
+
+
 @app.route("/metrics")
 async def metrics():
     """
     Get metrics of this service instance.
     :return: response object with metrics data
     """
+    sample_pools()
     data = generate_latest(registry)
     logger.debug(f"Metrics, returning: {data}")
     return Response(data, mimetype=CONTENT_TYPE_LATEST)
@@ -381,7 +863,6 @@ async def check_producer():
     """
     Check producer if ready, otherwise initialize.
     """
-    if not stock_producer.is_ready() or not payment_producer.is_ready():
+    if not rpc_client.is_ready():
         conn: OrderConnection = await connection.get_connection()
-        await stock_producer.connect(conn)
-        await payment_producer.connect(conn)
+        await rpc_client.connect(conn)
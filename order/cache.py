@@ -0,0 +1,252 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from prometheus_client import Counter
+
+logger = logging.getLogger('order-service')
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used entry when full, and expires entries after a TTL.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        """
+        :param max_size: maximum number of entries kept
+        :param ttl: seconds an entry is kept
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, Tuple[Any, float]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get an entry, None if it is not cached or expired.
+        """
+        cached = self.entries.get(key)
+        if cached is None:
+            return None
+        value, expires_at = cached
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        """
+        Cache an entry, evicting the least recently used entry if the cache is full.
+        """
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class PriceCache:
+    """
+    Bounded in-process LRU cache of item prices with a TTL.
+    Concurrent misses are coalesced into one batched lookup, so many requests for (different) uncached items
+    only cost a single round trip to the stock service.
+    """
+
+    def __init__(self, fetch: Callable[[List[str]], Awaitable[Dict[str, float]]],
+                 max_size: int, ttl: float, linger: float, max_batch: int) -> None:
+        """
+        :param fetch: coroutine function resolving a list of item IDs to a dict of prices, missing IDs are omitted
+        :param max_size: maximum number of prices kept, least recently used prices are evicted first
+        :param ttl: seconds a price is kept before it is fetched again
+        :param linger: seconds to wait for more misses before sending a batched lookup
+        :param max_batch: maximum number of item IDs in one batched lookup
+        """
+        self.fetch = fetch
+        self.linger = linger
+        self.max_batch = max_batch
+        self.prices = LRUCache(max_size, ttl)
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def get(self, item_id: str) -> Optional[float]:
+        """
+        Get the price of an item, fetching it from the stock service if it is not cached.
+        :param item_id: ID of item
+        :return: price of item, None if the item does not exist
+        """
+        price = self.prices.get(item_id)
+        if price is not None:
+            return price
+
+        future = self.pending.get(item_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[item_id] = future
+            self.schedule_flush()
+        return await asyncio.shield(future)
+
+    def schedule_flush(self):
+        """
+        Send the pending lookups once the batch is full or the linger time has passed.
+        """
+        if len(self.pending) >= self.max_batch:
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.linger, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        batch, self.pending = self.pending, {}
+        asyncio.ensure_future(self.resolve(batch))
+
+    async def resolve(self, batch: Dict[str, asyncio.Future]):
+        """
+        Fetch the prices of a batch of items and complete their futures.
+        :param batch: futures of the lookups by item ID
+        """
+        try:
+            prices = await self.fetch(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for item_id, future in batch.items():
+            price = prices.get(item_id)
+            if price is not None:
+                self.prices.put(item_id, price)
+            if not future.done():
+                future.set_result(price)
+
+    def invalidate(self, item_ids: Optional[Iterable[str]] = None):
+        """
+        Drop cached prices.
+        :param item_ids: IDs of items to drop, all prices are dropped if not given
+        """
+        if item_ids is None:
+            self.prices.clear()
+            return
+        for item_id in item_ids:
+            self.prices.pop(item_id)
+
+
+class OrderCache:
+    """
+    Read-through cache of orders with an in-process LRU tier and an optional Redis tier shared by all processes.
+    Writes invalidate the order in both tiers. Other processes only see that in the Redis tier,
+    so the in-process tier should have a short TTL unless all requests of an order reach the same process.
+    An invalidation leaves a tombstone in the Redis tier for a lease, and orders are only cached if the key is empty,
+    so a read that loaded the order before the write committed can not cache the old order again.
+    """
+
+    # Redis value of an invalidated order, a real order is a JSON object
+    TOMBSTONE = b'-'
+
+    def __init__(self, load: Callable[[str], Awaitable[Optional[dict]]], local_size: int, local_ttl: float,
+                 redis_url: str, redis_ttl: float, hits: Counter, misses: Counter, redis_lease: float = 5) -> None:
+        """
+        :param load: coroutine function loading an order as dictionary from the database, None if it does not exist
+        :param local_size: maximum number of orders in the in-process tier, 0 disables it
+        :param local_ttl: seconds an order is kept in the in-process tier
+        :param redis_url: URL of the Redis tier, empty disables it
+        :param redis_ttl: seconds an order is kept in the Redis tier
+        :param hits: counter of cache hits, labelled by tier
+        :param misses: counter of cache misses, labelled by tier
+        :param redis_lease: seconds an invalidated order is not cached in the Redis tier, longer than a load takes
+        """
+        self.load = load
+        self.local = LRUCache(local_size, local_ttl)
+        # Incremented by every invalidation, a load that overlapped one is not cached in the in-process tier
+        self.generation = 0
+        self.redis = None
+        self.redis_ttl = redis_ttl
+        self.redis_lease = redis_lease
+        self.hits = hits
+        self.misses = misses
+        if redis_url:
+            import redis.asyncio
+            self.redis = redis.asyncio.from_url(redis_url)
+
+    @property
+    def enabled(self) -> bool:
+        return self.local.max_size > 0 or self.redis is not None
+
+    @staticmethod
+    def key(order_id: str) -> str:
+        return f"order:{order_id}"
+
+    async def get(self, order_id: str) -> Optional[dict]:
+        """
+        Get an order, loading it from the database if it is not cached.
+        :param order_id: ID of order
+        :return: order as dictionary, None if it does not exist
+        """
+        if self.local.max_size > 0:
+            order = self.local.get(order_id)
+            if order is not None:
+                self.hits.labels('local').inc()
+                return order
+            self.misses.labels('local').inc()
+
+        generation = self.generation
+        cached = None
+        if self.redis is not None:
+            try:
+                cached = await self.redis.get(self.key(order_id))
+            except Exception:
+                logger.exception("Reading order from redis failed")
+            if cached is not None and cached != self.TOMBSTONE:
+                self.hits.labels('redis').inc()
+                order = json.loads(cached)
+                if generation == self.generation:
+                    self.local.put(order_id, order)
+                return order
+            self.misses.labels('redis').inc()
+
+        order = await self.load(order_id)
+        if order is None or generation != self.generation:
+            return order
+        self.local.put(order_id, order)
+        # Not cached while the order is invalidated recently, the load may have read it before the write
+        if self.redis is not None and cached is None:
+            try:
+                await self.redis.set(self.key(order_id), json.dumps(order), ex=int(self.redis_ttl), nx=True)
+            except Exception:
+                logger.exception("Writing order to redis failed")
+        return order
+
+    async def invalidate(self, order_id: str):
+        """
+        Drop an order after it was written, call this after the write is committed.
+        :param order_id: ID of order
+        """
+        self.generation += 1
+        self.local.pop(order_id)
+        if self.redis is not None:
+            try:
+                await self.redis.set(self.key(order_id), self.TOMBSTONE, px=int(self.redis_lease * 1000))
+            except Exception:
+                logger.exception("Invalidating order in redis failed")
+
+    async def clear(self):
+        """
+        Drop all orders.
+        """
+        self.local.clear()
+        if self.redis is not None:
+            async for key in self.redis.scan_iter(match=self.key('*')):
+                await self.redis.delete(key)
@@ -0,0 +1,273 @@
+import asyncio
+import functools
+import os
+import random
+import time
+from http import HTTPStatus
+from typing import Callable, List
+
+from prometheus_client import Counter, Gauge
+from quart import Quart, abort, g, has_request_context, request
+from sqlalchemy import Integer, cast, event, func
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import NullPool
+
+DB_URL = 'postgresql+asyncpg://{user}:{pw}@{host}/{db}'
+
+POSTGRES_HOST = os.environ['POSTGRES_HOST']
+POSTGRES_REPLICA_HOST = os.environ.get('POSTGRES_REPLICA_HOST', POSTGRES_HOST)
+
+# Every uvicorn worker and consumer process has its own pool, so size it per process:
+# a pod opens at most workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+POOL_OPTIONS = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', -1)),
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'false').lower() == 'true',
+}
+PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false').lower() == 'true'
+
+# Where read only endpoints read from:
+#   primary: always the primary
+#   sticky:  the replica, unless the client made a write in the last REPLICA_STICKY_SECONDS (read-your-writes)
+#   replica: always the replica, reads may be stale
+REPLICA_POLICY = os.environ.get('REPLICA_POLICY', 'primary')
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# Cookie carrying the time until which a client reads from the primary, sent to every service behind the gateway,
+# so the stickiness holds whichever process or pod serves the read
+REPLICA_STICKY_COOKIE = 'read-primary-until'
+
+# Attempts of a transaction aborted by a deadlock or serialization failure, and the backoff before the second attempt
+DB_TRANSACTION_ATTEMPTS = int(os.environ.get('DB_TRANSACTION_ATTEMPTS', 3))
+DB_RETRY_BACKOFF = float(os.environ.get('DB_RETRY_BACKOFF', 0.01))
+# SQLSTATEs of serialization_failure and deadlock_detected
+CONFLICT_SQLSTATES = {'40001', '40P01'}
+
+
+def create_engine(host: str) -> AsyncEngine:
+    """
+    Create an engine for the database on the given host.
+    :param host: host of the postgres instance
+    :return: the engine
+    """
+    url = DB_URL.format(user=os.environ['POSTGRES_USER'],
+                        pw=os.environ['POSTGRES_PASSWORD'],
+                        host=host,
+                        db=os.environ['POSTGRES_DB'])
+    if PGBOUNCER:
+        # PgBouncer in transaction pooling mode does the pooling and can hand every transaction a different
+        # server connection, so don't keep connections here and don't cache prepared statements on them.
+        return create_async_engine(url, poolclass=NullPool,
+                                   connect_args={'statement_cache_size': 0, 'prepared_statement_cache_size': 0})
+    return create_async_engine(url, **POOL_OPTIONS)
+
+
+engine = create_engine(POSTGRES_HOST)
+if REPLICA_POLICY == 'primary' or POSTGRES_REPLICA_HOST == POSTGRES_HOST:
+    replica_engine = engine
+else:
+    replica_engine = create_engine(POSTGRES_REPLICA_HOST)
+
+# Sessions are cheap to create, every handler opens its own with `async with Session() as session`.
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+ReplicaSession = sessionmaker(replica_engine, class_=AsyncSession, expire_on_commit=False)
+
+Base = declarative_base()
+
+# Functions sampling the state of each instrumented connection pool into its gauges
+pool_samplers: List[Callable[[], None]] = []
+
+
+def mark_written():
+    """
+    Remember that the current request wrote, so its client reads from the primary for a while, see sticky_reads.
+    Writes outside of a request, e.g. by a queue consumer, are made sticky by the request that caused them.
+    """
+    if REPLICA_POLICY == 'sticky' and has_request_context():
+        g.wrote = True
+
+
+def sticky_reads(app: Quart):
+    """
+    Make the client of a request that wrote read from the primary for REPLICA_STICKY_SECONDS, by setting
+    REPLICA_STICKY_COOKIE on the response.
+    :param app: app to set the cookie for
+    """
+    if REPLICA_POLICY != 'sticky':
+        return
+
+    @app.after_request
+    async def set_sticky_cookie(response):
+        if g.get('wrote'):
+            response.set_cookie(REPLICA_STICKY_COOKIE, str(time.time() + REPLICA_STICKY_SECONDS),
+                                max_age=int(REPLICA_STICKY_SECONDS) + 1, path='/')
+        return response
+
+
+def read_session() -> AsyncSession:
+    """
+    Create a session for read only queries, routed according to REPLICA_POLICY.
+    :return: session on the replica or the primary
+    """
+    if replica_engine is engine:
+        return Session()
+    if REPLICA_POLICY == 'sticky' and has_request_context():
+        try:
+            read_primary_until = float(request.cookies.get(REPLICA_STICKY_COOKIE, 0))
+        except ValueError:
+            read_primary_until = 0
+        if read_primary_until > time.time():
+            return Session()
+    return ReplicaSession()
+
+
+def instrument_pool():
+    """
+    Export the state of the connection pools as gauges.
+    Call this after the prometheus multiprocess directory is set up.
+    """
+    checked_out = Gauge("db_pool_checked_out", "Connections checked out of the pool", ['engine'],
+                        multiprocess_mode='livesum')
+    idle = Gauge("db_pool_idle", "Idle connections in the pool", ['engine'], multiprocess_mode='livesum')
+    overflow = Gauge("db_pool_overflow", "Connections opened beyond the pool size", ['engine'],
+                     multiprocess_mode='livesum')
+
+    def instrument(name, async_engine):
+        pool = async_engine.sync_engine.pool
+        if isinstance(pool, NullPool):
+            return
+
+        def sample():
+            checked_out.labels(name).set(pool.checkedout())
+            idle.labels(name).set(pool.checkedin())
+            overflow.labels(name).set(max(pool.overflow(), 0))
+
+        def sample_soon(*_):
+            # The events fire before the pool updates its counts, e.g. checkin before the connection is returned
+            try:
+                asyncio.get_running_loop().call_soon(sample)
+            except RuntimeError:
+                sample()
+
+        pool_samplers.append(sample)
+        for event_name in ('connect', 'checkout', 'checkin', 'close', 'invalidate'):
+            event.listen(async_engine.sync_engine, event_name, sample_soon)
+
+    instrument('primary', engine)
+    if replica_engine is not engine:
+        instrument('replica', replica_engine)
+
+
+def sample_pools():
+    """
+    Sample the state of the connection pools of this process into their gauges, call this when the metrics are
+    collected. The multiprocess registry only reads the values the processes wrote, so every process also samples its
+    pools after each pool event.
+    """
+    for sample in pool_samplers:
+        sample()
+
+
+def is_conflict(error: DBAPIError) -> bool:
+    """
+    Check if a transaction was aborted by a deadlock or a serialization failure, so running it again can succeed.
+    """
+    sqlstate = getattr(error.orig, 'sqlstate', None) or getattr(error.orig.__cause__, 'sqlstate', None)
+    return sqlstate in CONFLICT_SQLSTATES
+
+
+def retry_on_conflict(retries: Counter, name: str):
+    """
+    Run a transaction again when it is aborted by a deadlock or a serialization failure, at most
+    DB_TRANSACTION_ATTEMPTS times with exponential backoff and jitter.
+    The decorated coroutine function must open its own session, so every attempt runs in a new transaction.
+    :param retries: counter of retried transactions, labelled by name
+    :param name: name of the transaction
+    :return: decorator
+    """
+    def decorate(transaction):
+        @functools.wraps(transaction)
+        async def run(*args, **kwargs):
+            attempt = 1
+            while True:
+                try:
+                    return await transaction(*args, **kwargs)
+                except DBAPIError as e:
+                    if attempt >= DB_TRANSACTION_ATTEMPTS or not is_conflict(e):
+                        raise
+                retries.labels(name).inc()
+                await asyncio.sleep(random.uniform(0, DB_RETRY_BACKOFF * 2 ** (attempt - 1)))
+                attempt += 1
+        return run
+    return decorate
+
+
+def id_series(n: int):
+    """
+    Column of the numbers 0 to n - 1, to generate n rows in the database instead of sending them.
+    :param n: number of rows
+    :return: column to select from
+    """
+    return func.generate_series(cast(0, Integer), cast(n - 1, Integer)).column_valued('i')
+
+
+async def create_tables():
+    """
+    Create all needed tables in the database.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def drop_tables():
+    """
+    Drop all tables in the database.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+
+async def get_or_404(session: AsyncSession, model, ident):
+    """
+    Get an entity by primary key, or abort with 404 if it does not exist.
+    :param session: session to query with
+    :param model: model class of the entity
+    :param ident: primary key of the entity
+    :return: the entity
+    """
+    instance = await session.get(model, ident)
+    if instance is None:
+        abort(HTTPStatus.NOT_FOUND)
+    return instance
+
+
+async def read_entity(model, ident):
+    """
+    Get an entity by primary key for a read only query.
+    Reads are routed according to REPLICA_POLICY, an entity that is not on the replica (yet) is read from the primary.
+    :param model: model class of the entity
+    :param ident: primary key of the entity
+    :return: the entity, None if it does not exist
+    """
+    async with read_session() as session:
+        instance = await session.get(model, ident)
+    if instance is None and replica_engine is not engine:
+        async with Session() as session:
+            instance = await session.get(model, ident)
+    return instance
+
+
+async def read_or_404(model, ident):
+    """
+    Get an entity by primary key for a read only endpoint, or abort with 404 if it does not exist, see read_entity.
+    :param model: model class of the entity
+    :param ident: primary key of the entity
+    :return: the entity
+    """
+    instance = await read_entity(model, ident)
+    if instance is None:
+        abort(HTTPStatus.NOT_FOUND)
+    return instance
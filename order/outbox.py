@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+from prometheus_client import Counter
+from sqlalchemy import BigInteger, Column, DateTime, String, Text, delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Base, Session
+from producer import RpcClient
+
+# Outbox messages published by the relay in one batch, the broker confirms them together
+OUTBOX_BATCH = int(os.environ.get('OUTBOX_BATCH', 100))
+# Seconds the relay waits for new messages before checking the outbox again, e.g. for messages of other processes
+OUTBOX_RELAY_INTERVAL = float(os.environ.get('OUTBOX_RELAY_INTERVAL', 1))
+
+logger = logging.getLogger('order-service')
+
+
+class OutboxMessage(Base):
+    """
+    Message to another service, written in the transaction that decides to send it and published by the relay.
+    A message is deleted once the broker confirmed it, so it is sent at least once; the consumers deduplicate it by
+    its message ID.
+    """
+    __tablename__ = 'outbox'
+
+    # Increasing, so the oldest messages are published first
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    queue = Column(String, nullable=False)
+    task = Column(String, nullable=False)
+    message_id = Column(String, nullable=False)
+    partition_key = Column(String, nullable=True)
+    # JSON object, encoded with the codec of the relay when it is published
+    body = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+async def add_message(session: AsyncSession, queue: str, task: str, body: dict, message_id: str,
+                      partition_key: Optional[str] = None):
+    """
+    Write a message to the outbox, it is published once the transaction commits.
+    :param session: session of the transaction, e.g. the one finishing a saga
+    :param queue: name of the queue
+    :param task: task of the message
+    :param body: body of the message
+    :param message_id: ID the consumer deduplicates the message by
+    :param partition_key: ID of the entity the message is about, e.g. a user ID
+    """
+    await session.execute(insert(OutboxMessage).values(
+        queue=queue, task=task, body=json.dumps(body), message_id=message_id, partition_key=partition_key
+    ))
+
+
+class OutboxRelay:
+    """
+    Publishes the messages of the outbox to the broker in batches, from every order process.
+    Each batch is claimed with SKIP LOCKED, so processes relaying at the same time publish different messages.
+    """
+
+    def __init__(self, client: RpcClient, connect: Callable[[], Awaitable], relayed: Counter) -> None:
+        """
+        :param client: client publishing the messages, its channel has publisher confirms enabled and raises for
+            returned messages
+        :param connect: coroutine function connecting the client if it is not connected
+        :param relayed: counter of the published messages
+        """
+        self.client = client
+        self.connect = connect
+        self.relayed = relayed
+        self.written: Optional[asyncio.Event] = None
+
+    def wake(self):
+        """
+        Publish the messages written by this process now, instead of after OUTBOX_RELAY_INTERVAL.
+        """
+        if self.written is not None:
+            self.written.set()
+
+    async def relay_batch(self) -> int:
+        """
+        Publish the oldest OUTBOX_BATCH messages, and delete them once the broker confirmed all of them.
+        If publishing fails, the whole batch is kept and published again, also if the broker returned a message
+        because no queue is bound for it.
+        :return: number of messages published
+        """
+        async with Session() as session:
+            result = await session.execute(
+                select(OutboxMessage).order_by(OutboxMessage.id).limit(OUTBOX_BATCH).with_for_update(skip_locked=True)
+            )
+            messages = list(result.scalars())
+            if not messages:
+                return 0
+
+            # Every publish waits for its confirm, publishing them concurrently lets the broker confirm them together
+            await asyncio.gather(*(
+                self.client.publish(message.queue, json.loads(message.body), message.task, reply=False,
+                                    message_id=message.message_id, partition_key=message.partition_key)
+                for message in messages
+            ))
+            await session.execute(delete(OutboxMessage).where(OutboxMessage.id.in_([m.id for m in messages])))
+            await session.commit()
+        self.relayed.inc(len(messages))
+        return len(messages)
+
+    async def run(self):
+        """
+        Keep publishing the outbox, woken up by wake or every OUTBOX_RELAY_INTERVAL seconds.
+        """
+        self.written = asyncio.Event()
+        while True:
+            self.written.clear()
+            try:
+                await self.connect()
+                # Keep publishing without waiting while there is a backlog
+                if await self.relay_batch() >= OUTBOX_BATCH:
+                    continue
+            except Exception:
+                logger.exception("Relaying the outbox failed")
+            try:
+                await asyncio.wait_for(self.written.wait(), OUTBOX_RELAY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 import asyncio
+import itertools
+import logging
+import time
 import uuid
-from typing import MutableMapping
+from copy import copy
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
 
 from aio_pika import Message, connect
 from aio_pika.abc import (
-    AbstractChannel, AbstractConnection, AbstractIncomingMessage, AbstractQueue, DeliveryMode,
+    AbstractChannel, AbstractConnection, AbstractExchange, AbstractIncomingMessage, AbstractQueue, DeliveryMode,
 )
+from aio_pika.exceptions import DeliveryError
+from prometheus_client import Counter, Gauge
+
+from codec import Codec, JsonCodec, get_codec
+
+logger = logging.getLogger('order-service')
 
 
 class OrderConnection:
@@ -30,86 +41,310 @@ class OrderConnection:
         return self.connection
 
 
-class Producer:
-    connection: AbstractConnection
-    channel: AbstractChannel
-    callback_queue: AbstractQueue
+class RpcUnavailable(Exception):
+    """
+    Raised instead of sending an RPC to a service that is failing, or when too many RPCs are waiting for a reply.
+    """
+
+
+@dataclass
+class RpcMetrics:
+    timeouts: Counter
+    rejected: Counter
+    open_circuits: Gauge
+    in_flight: Gauge
+
 
-    def __init__(self, queue) -> None:
+class CircuitBreaker:
+    """
+    Stops RPCs to a queue after failure_threshold consecutive timeouts or errors, so requests fail fast instead of
+    piling up while the consumer is down. After reset_timeout seconds a single RPC is let through to probe the queue,
+    closing the circuit if it succeeds.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def can_probe(self) -> bool:
+        return not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def available(self) -> bool:
         """
-        Initializing Producer entity for order service.
-        This Producer can produce to an queue and consume from a callback queue.
-        :param queue: key of queue to create
+        Check if an RPC would be let through, without taking the probe.
         """
-        self.futures: MutableMapping[str, asyncio.Future] = {}
-        self.loop = asyncio.get_running_loop()
-        self.queue = queue
+        return not self.is_open or self.can_probe()
+
+    def allow(self) -> bool:
+        """
+        Check if an RPC may be sent, taking the probe if the circuit is open.
+        """
+        if not self.is_open:
+            return True
+        if self.can_probe():
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+@dataclass
+class PendingRequest:
+    message: Message
+    queue: str
+    partition_key: Optional[str]
+    future: asyncio.Future
+
+
+class RpcClient:
+    """
+    Sends messages to the queues of other services, and receives their replies on a single callback queue.
+    One client (one channel and one callback queue) is shared by all producers of the process.
+    RPCs are rejected with RpcUnavailable while the circuit of their queue is open or max_in_flight RPCs are waiting
+    for a reply. Messages without a reply (e.g. compensations) are always sent, the broker queues them.
+    Messages with a partition key to a partitioned queue are sent through its consistent-hash exchange, so all
+    messages about the same entity reach the same consumer.
+    """
+    connection: Optional[AbstractConnection]
+    channel: Optional[AbstractChannel]
+    callback_queue: Optional[AbstractQueue]
+
+    def __init__(self, max_in_flight: int = 0, failure_threshold: int = 5, reset_timeout: float = 5,
+                 metrics: Optional[RpcMetrics] = None, partitioned: Iterable[str] = (),
+                 codec: Codec = JsonCodec()) -> None:
+        """
+        :param max_in_flight: maximum number of RPCs waiting for a reply, 0 for no limit
+        :param failure_threshold: consecutive failed RPCs to a queue that open its circuit
+        :param reset_timeout: seconds an open circuit rejects RPCs before probing the queue again
+        :param metrics: metrics of timeouts, rejected RPCs, open circuits and RPCs in flight
+        :param partitioned: queues whose consumers own a partition of the entities
+        :param codec: codec of the message bodies, the consumers reply in the same codec
+        """
+        self.max_in_flight = max_in_flight
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.metrics = metrics
+        self.codec = codec
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.partitioned = set(partitioned)
+        self.exchanges: Dict[str, AbstractExchange] = {}
+        self.pending: Dict[str, PendingRequest] = {}
         self.connection = None
+        self.channel = None
         self.callback_queue = None
+        self.connect_lock = asyncio.Lock()
+        # Correlation IDs are unique per process by the prefix, and cheap to generate by the counter
+        self.correlation_prefix = uuid.uuid4().hex[:12]
+        self.correlation_counter = itertools.count()
 
     def is_ready(self) -> bool:
         """
-        Check to see if the producer is ready to create channel/queue, by checking connection.
-        :return: boolean indicating if producer is ready
+        Check to see if the client is connected and can publish.
+        :return: boolean indicating if client is ready
         """
-        return self.connection is not None and self.connection.is_closed is False
+        return self.connection is not None and not self.connection.is_closed \
+            and self.channel is not None and not self.channel.is_closed
 
     async def connect(self, connection):
         """
-        Using the connection to create channel and queue, then start consuming for a reply.
+        Using the connection to create a channel and the callback queue, then start consuming for replies.
+        Requests that were sent on a previous connection are sent again, as their replies went to a callback
+        queue that no longer exists. The consumers deduplicate messages, so this is safe for messages with an ID.
         """
-        self.connection = connection
-        self.channel = await self.connection.channel()
-        self.callback_queue = await self.channel.declare_queue(exclusive=True)
-        await self.callback_queue.consume(self.on_response)
+        async with self.connect_lock:
+            if self.is_ready():
+                return
+            self.connection = connection
+            # A message no queue is bound for is returned by the broker, raise instead of taking its confirm as sent
+            self.channel = await self.connection.channel(publisher_confirms=True, on_return_raises=True)
+            self.callback_queue = await self.channel.declare_queue(exclusive=True)
+            await self.callback_queue.consume(self.on_response, no_ack=True)
+            self.exchanges = {
+                queue: await self.channel.declare_exchange(f"{queue}.partitioned", "x-consistent-hash", durable=True)
+                for queue in self.partitioned
+            }
 
-    async def consume(self):
-        await self.callback_queue.consume(self.on_response)
+            for request in list(self.pending.values()):
+                # Published messages are locked, so send a copy
+                request.message = copy(request.message)
+                request.message.reply_to = self.callback_queue.name
+                try:
+                    await self.send(request.message, request.queue, request.partition_key)
+                except DeliveryError as e:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+            if self.pending:
+                logger.warning(f"Sent {len(self.pending)} pending requests again after reconnecting")
 
     async def on_response(self, message: AbstractIncomingMessage) -> None:
         """
         Handles incoming messages and sets the result of the Future if it receives a reply.
         :param message: incoming message from callback queue
         """
-        async with message.process():
-            if message.correlation_id is None:
-                print(f"Incorrect message {message!r}")
+        if message.correlation_id is None:
+            logger.warning(f"Incorrect message {message!r}")
+            return
+
+        # A request that timed out is no longer pending, its late reply is dropped
+        request = self.pending.pop(message.correlation_id, None)
+        if request is not None and not request.future.done():
+            try:
+                body = get_codec(message.content_type).decode(message.body)
+            except Exception as e:
+                request.future.set_exception(e)
                 return
+            request.future.set_result({"message": body, "status": message.type})
 
-            # Set the result of the Future
-            future: asyncio.Future = self.futures.pop(message.correlation_id)
-            future.set_result({"message": message.body.decode(), "status": message.type})
+    def breaker(self, routing_key) -> CircuitBreaker:
+        if routing_key not in self.breakers:
+            self.breakers[routing_key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self.breakers[routing_key]
 
-    async def publish(self, body, task=None, reply=False):
+    def is_available(self, routing_key) -> bool:
         """
-        Sends a task to the corresponding queue.
-        :param body: body of message to be sent into queue
+        Check if an RPC to a queue would be sent now, to reject a request before starting work for it.
+        :param routing_key: name of the queue
+        :return: boolean indicating if the circuit of the queue is closed and the in-flight limit not reached
+        """
+        return self.breaker(routing_key).available() \
+            and (self.max_in_flight <= 0 or len(self.pending) < self.max_in_flight)
+
+    def reject(self, routing_key, reason):
+        if self.metrics is not None:
+            self.metrics.rejected.labels(routing_key, reason).inc()
+        raise RpcUnavailable(f"RPC to {routing_key} rejected: {reason}")
+
+    def record(self, routing_key, success: Optional[bool]):
+        """
+        Update the circuit of a queue with the outcome of an RPC.
+        :param routing_key: name of the queue
+        :param success: whether a reply was received, None if the RPC was cancelled
+        """
+        breaker = self.breaker(routing_key)
+        was_open = breaker.is_open
+        if success is None:
+            # A cancelled probe tells nothing about the queue, let the next RPC probe it
+            breaker.probing = False
+        elif success:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        if breaker.is_open != was_open:
+            logger.warning(f"Circuit of {routing_key} {'opened' if breaker.is_open else 'closed'}")
+            if self.metrics is not None:
+                self.metrics.open_circuits.labels(routing_key).set(int(breaker.is_open))
+
+    async def send(self, message: Message, queue: str, partition_key: Optional[str]):
+        """
+        Publish a message to a queue, or to the consumer owning its partition key if the queue is partitioned.
+        """
+        if partition_key is not None and queue in self.exchanges:
+            await self.exchanges[queue].publish(message, routing_key=partition_key)
+        else:
+            await self.channel.default_exchange.publish(message, routing_key=queue)
+
+    async def publish(self, routing_key, body, task=None, reply=False, message_id=None, timeout=None,
+                      partition_key=None):
+        """
+        Sends a task to a queue, and waits until the broker confirmed it.
+        A message that is not routed to a queue raises DeliveryError, e.g. if the consumers did not declare it yet.
+        :param routing_key: name of the queue
+        :param body: body of message to be sent into queue, encoded with the codec of the client
         :param task: indicating the task to handle this message
         :param reply: indicates if reply is expected
+        :param message_id: ID the consumer deduplicates the message by, so it can be sent again safely
+        :param timeout: seconds to wait for the reply, raises asyncio.TimeoutError when exceeded
+        :param partition_key: ID of the entity the message is about, e.g. a user ID
         :return: response if reply is expected
+        :raises RpcUnavailable: if a reply is expected and the RPC is rejected
         """
-        correlation_id = str(uuid.uuid4())
-        reply_queue = None
-        # If a response is expected, set up the reply_to queue
-        if reply:
-            reply_queue = self.callback_queue.name
+        message = Message(
+            body=self.codec.encode(body),
+            content_type=self.codec.content_type,
+            message_id=message_id,
+            delivery_mode=DeliveryMode.PERSISTENT,
+            type=task,
+            headers=None if partition_key is None else {"partition_key": partition_key}
+        )
+
+        if not reply:
+            await self.send(message, routing_key, partition_key)
+            return None
+
+        if self.max_in_flight > 0 and len(self.pending) >= self.max_in_flight:
+            self.reject(routing_key, "overloaded")
+        if not self.breaker(routing_key).allow():
+            self.reject(routing_key, "circuit_open")
 
         # A Future represents an eventual result of an asynchronous operation.
-        future = self.loop.create_future()
-        self.futures[correlation_id] = future
-
-        asyncio.ensure_future(self.channel.default_exchange.publish(
-            Message(
-                body=body.encode(),
-                correlation_id=correlation_id,
-                reply_to=reply_queue,
-                delivery_mode=DeliveryMode.PERSISTENT,
-                type=task
-            ),
-            routing_key=self.queue
-        ))
-
-        # If an reply is expected, wait till the Future is ready
-        if reply:
-            response = await future
+        correlation_id = f"{self.correlation_prefix}-{next(self.correlation_counter)}"
+        message.correlation_id = correlation_id
+        message.reply_to = self.callback_queue.name
+        future = asyncio.get_running_loop().create_future()
+        self.pending[correlation_id] = PendingRequest(message, routing_key, partition_key, future)
+        if self.metrics is not None:
+            self.metrics.in_flight.inc()
+
+        success = None
+        try:
+            await self.send(message, routing_key, partition_key)
+            response = await asyncio.wait_for(future, timeout)
+            success = True
             return response
+        except asyncio.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.timeouts.labels(routing_key).inc()
+            success = False
+            raise
+        except Exception:
+            success = False
+            raise
+        finally:
+            self.pending.pop(correlation_id, None)
+            if self.metrics is not None:
+                self.metrics.in_flight.dec()
+            self.record(routing_key, success)
+
+
+class Producer:
+    """
+    Producer for the queue of one service, sending its messages through the shared RpcClient.
+    """
+
+    def __init__(self, client: RpcClient, queue) -> None:
+        """
+        Initializing Producer entity for order service.
+        :param client: client sending the messages
+        :param queue: key of queue to produce to
+        """
+        self.client = client
+        self.queue = queue
+
+    def is_available(self) -> bool:
+        """
+        Check if an RPC to the queue of this producer would be sent now, see RpcClient.is_available.
+        """
+        return self.client.is_available(self.queue)
+
+    async def publish(self, body, task=None, reply=False, message_id=None, timeout=None, partition_key=None):
+        """
+        Sends a task to the queue of this producer, see RpcClient.publish.
+        """
+        return await self.client.publish(self.queue, body, task, reply, message_id, timeout, partition_key)
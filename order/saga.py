@@ -0,0 +1,123 @@
+import enum
+import os
+from datetime import timedelta
+from typing import List, Optional
+
+from sqlalchemy import Column, DateTime, Enum, SmallInteger, String, Text, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Base, Session
+
+# Seconds after its last update an unfinished saga is considered stuck, well above the RPC timeout
+SAGA_RECOVERY_AFTER = float(os.environ.get('SAGA_RECOVERY_AFTER', 2 * float(os.environ.get('RPC_TIMEOUT', 30))))
+SAGA_RECOVERY_INTERVAL = float(os.environ.get('SAGA_RECOVERY_INTERVAL', 10))
+# Stuck sagas claimed by one recovery round
+SAGA_RECOVERY_BATCH = int(os.environ.get('SAGA_RECOVERY_BATCH', 100))
+
+
+class SagaStatus(str, enum.Enum):
+    # The pay and subtractItems messages are sent, their replies are not known yet
+    STARTED = 'started'
+    # Two-phase checkout: both steps are prepared and the order is paid, the commits are being sent.
+    # Only sagas logged before the outbox are committing, the commits are now written with the completed status.
+    COMMITTING = 'committing'
+    # At least one of the steps failed, the compensations of the steps that succeeded are being sent.
+    # Only sagas logged before the outbox are compensating, the compensations are now written with the failed status.
+    COMPENSATING = 'compensating'
+    # Both steps succeeded and the order is paid, the commits of the steps are in the outbox
+    COMPLETED = 'completed'
+    # The checkout failed and the compensations of the steps that succeeded are in the outbox
+    FAILED = 'failed'
+
+
+class Saga(Base):
+    """
+    Log of one checkout attempt of an order, so a checkout interrupted by a crash can be finished by another process.
+    The messages of a saga have IDs derived from its ID, so sending them again is safe.
+    """
+    __tablename__ = 'sagas'
+
+    # ID of the checkout attempt
+    id = Column(String, primary_key=True)
+    order_id = Column(String, nullable=False, index=True)
+    status = Column(Enum(SagaStatus, native_enum=False, length=16), nullable=False)
+    payment_body = Column(Text, nullable=False)
+    stock_body = Column(Text, nullable=False)
+    # Status codes of the replies of the steps, known once the saga is compensating or finished
+    payment_status = Column(SmallInteger, nullable=True)
+    stock_status = Column(SmallInteger, nullable=True)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
+
+
+async def start_saga(saga_id: str, order_id: str, payment_body: str, stock_body: str) -> Saga:
+    """
+    Log the start of a checkout, before any of its messages is sent.
+    :param saga_id: ID of the checkout attempt
+    :param order_id: ID of order being checked out
+    :param payment_body: body of the pay message
+    :param stock_body: body of the subtractItems message
+    :return: the started saga
+    """
+    saga = Saga(id=saga_id, order_id=order_id, status=SagaStatus.STARTED,
+                payment_body=payment_body, stock_body=stock_body)
+    async with Session() as session:
+        session.add(saga)
+        await session.commit()
+    return saga
+
+
+async def transition(session: AsyncSession, saga: Saga, status: SagaStatus, **values) -> bool:
+    """
+    Move a saga to the next status, unless another process moved it on already.
+    :param session: session of the transaction, e.g. the one marking the order paid
+    :param saga: saga in the status it was read in
+    :param status: new status of the saga
+    :param values: other columns to update
+    :return: whether the saga was moved
+    """
+    result = await session.execute(
+        update(Saga).where(Saga.id == saga.id, Saga.status == saga.status)
+        .values(status=status, updated_at=func.now(), **values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        return False
+    saga.status = status
+    for column, value in values.items():
+        setattr(saga, column, value)
+    return True
+
+
+async def claim_stuck_sagas() -> List[Saga]:
+    """
+    Claim sagas that have not been updated for SAGA_RECOVERY_AFTER seconds and are not finished.
+    Claiming touches their updated_at, so other processes do not recover them at the same time.
+    :return: the claimed sagas
+    """
+    stuck = select(Saga.id).where(
+        Saga.status.in_([SagaStatus.STARTED, SagaStatus.COMMITTING, SagaStatus.COMPENSATING]),
+        Saga.updated_at < func.now() - timedelta(seconds=SAGA_RECOVERY_AFTER)
+    ).order_by(Saga.updated_at).limit(SAGA_RECOVERY_BATCH).with_for_update(skip_locked=True)
+
+    async with Session() as session:
+        claim = update(Saga).where(Saga.id.in_(stuck.scalar_subquery())).values(updated_at=func.now()) \
+            .returning(*Saga.__table__.columns)
+        result = await session.execute(select(Saga).from_statement(claim))
+        sagas = list(result.scalars())
+        await session.commit()
+    return sagas
+
+
+async def latest_saga(order_id: str) -> Optional[Saga]:
+    """
+    Get the saga of the last checkout attempt of an order.
+    :param order_id: ID of order
+    :return: the saga, None if the order was never checked out
+    """
+    # From the primary, the saga is written in the background while its status is polled
+    async with Session() as session:
+        result = await session.execute(
+            select(Saga).where(Saga.order_id == order_id).order_by(Saga.created_at.desc()).limit(1)
+        )
+        return result.scalar_one_or_none()
@@ -1,16 +1,26 @@
+import asyncio
 import logging
 import os
-import shutil
 import uuid
 from http import HTTPStatus
+from typing import Optional
 
-from flask_sqlalchemy import SQLAlchemy
 from prometheus_async.aio import time
-from prometheus_client import CollectorRegistry, multiprocess, Summary, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import Summary, CONTENT_TYPE_LATEST, generate_latest
 from quart import Quart, make_response, jsonify, Response
-from sqlalchemy import CheckConstraint
+from sqlalchemy import Float, String, cast, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import ProgrammingError
 
+from database import (
+    Session, create_tables, drop_tables, id_series, instrument_pool, mark_written, read_or_404, read_session,
+    sample_pools, sticky_reads,
+)
+from idempotency import expire_processed_messages
+from metrics import registry
+from runtime import ConsumerRuntime
+from service import Payment, Result, User, cancel_payment, construct_payment_id, remove_credit
+
 app_name = 'payment-service'
 app = Quart(app_name)
 
@@ -20,24 +30,15 @@ logging.getLogger(app_name).setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
 logger = logging.getLogger(app_name)
 logger.warning(f"LOG_LEVEL: {os.environ.get('LOG_LEVEL')}")
 
-DB_URL = 'postgresql+psycopg2://{user}:{pw}@{host}/{db}' \
-    .format(user=os.environ['POSTGRES_USER'],
-            pw=os.environ['POSTGRES_PASSWORD'],
-            host=os.environ['POSTGRES_HOST'],
-            db=os.environ['POSTGRES_DB'])
-
-app.config['SQLALCHEMY_DATABASE_URI'] = DB_URL
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # silence the deprecation warning
-
-db = SQLAlchemy(app)
-
-PROMETHEUS_MULTIPROC_DIR = os.environ["PROMETHEUS_MULTIPROC_DIR"]
-# make sure the dir is clean
-shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
-os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+# Consume the queue of the service in the app process, sharing the database pool and metrics with the routes,
+# instead of running consumer.py in a separate deployment
+CONSUMER_IN_APP = os.environ.get('CONSUMER_IN_APP', 'false').lower() == 'true'
+consumer: Optional[ConsumerRuntime] = None
+consumer_task: Optional[asyncio.Task] = None
+message_expiry: Optional[asyncio.Task] = None
 
-registry = CollectorRegistry()
-multiprocess.MultiProcessCollector(registry)
+instrument_pool()
+sticky_reads(app)
 
 
 create_user_metric = Summary("create_user", "Summary of /create_user endpoint")
@@ -46,104 +47,65 @@ add_credit_metric = Summary("add_credit", "Summary of /add_funds/<user_id>/<amou
 pay_metric = Summary("pay", "Summary of /pay/<user_id>/<order_id>/<amount>")
 cancel_metric = Summary("cancel", "/cancel/<user_id>/<order_id>")
 payment_status_metric = Summary("payment_status", "/status/<user_id>/<order_id>")
-cancel_payment_metric = Summary("db_cancel_payment", "cancel payment")
+batch_init_metric = Summary("batch_init", "Summary of /batch_init/<n>/<starting_money>")
 
 
-class User(db.Model):
-    __tablename__ = 'users'
+async def respond(result: Result):
+    """
+    Create the response of a route from the result of the service layer.
+    :param result: result of the operation
+    :return: response with the body and status code of the result
+    """
+    body = jsonify(result.body) if isinstance(result.body, dict) else result.body
+    return await make_response(body, result.status)
 
-    id = db.Column(db.String(), primary_key=True)
-    credit = db.Column(db.Float, unique=False, nullable=False)
-    __table_args__ = (
-        CheckConstraint(credit >= 0, name='check_credit_positive'), {}
-    )
 
-    def __init__(self, id, credit):
-        """
-        User object containing all relevant fields.
-        :param id: ID of User
-        :param credit: Credit of User
-        """
-        self.id = id
-        self.credit = credit
-
-    def as_dict(self):
-        """
-        Convert object to a dictionary.
-        :return: dictionary of User object
-        """
-        dct: dict = self.__dict__.copy()
-        dct.pop('_sa_instance_state', None)
-        return dct
-
-
-class Payment(db.Model):
-    __tablename__ = 'payments'
-
-    id = db.Column(db.String(), primary_key=True)
-    user_id = db.Column(db.String(), unique=False, nullable=False)
-    order_id = db.Column(db.String(), unique=False, nullable=False)
-    amount = db.Column(db.Float, unique=False, nullable=False)
-    paid = db.Column(db.Boolean, unique=False, nullable=False)
-
-    def __init__(self, id, user_id, order_id, amount, paid):
-        """
-        Payment object containing all relevant fields.
-        :param id: ID of Payment
-        :param user_id: User doing the Payment
-        :param order_id: Order corresponding to Payment
-        :param amount: Price of the payment
-        :param paid: Status of payment
-        """
-        self.id = id
-        self.user_id = user_id
-        self.order_id = order_id
-        self.amount = amount
-        self.paid = paid
-
-    def as_dict(self):
-        """
-        Convert object to a dictionary.
-        :return: dictionary of Payment object
-        """
-        dct = self.__dict__.copy()
-        dct.pop('_sa_instance_state', None)
-        return dct
-
-
-# Create all needed tables in database.
-db.create_all()
-db.session.commit()
-
-
-def recreate_tables():
+@app.before_serving
+async def startup():
+    """
+    Create all needed tables in database, and start consuming the queue of the service if CONSUMER_IN_APP is set.
+    """
+    global consumer, consumer_task, message_expiry
+    await create_tables()
+    if CONSUMER_IN_APP:
+        # The consumer imports the app for its process setup, so it can only be imported once the app is loaded
+        from consumer import create_runtime
+        consumer = create_runtime()
+        consumer_task = asyncio.create_task(consumer.run(handle_signals=False))
+        consumer_task.add_done_callback(consumer_stopped)
+        message_expiry = asyncio.create_task(expire_processed_messages())
+
+
+@app.after_serving
+async def shutdown():
+    """
+    Stop consuming and wait for the messages being processed.
+    """
+    if message_expiry is not None:
+        message_expiry.cancel()
+    if consumer_task is not None:
+        consumer.stop()
+        await asyncio.wait([consumer_task])
+
+
+def consumer_stopped(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Consuming the queue failed", exc_info=task.exception())
+
+
+async def recreate_tables():
     """
     Recreate all tables in the database.
     """
     logger.debug("DB drop all")
     try:
-        db.session.close()
-        db.drop_all()
+        await drop_tables()
     except ProgrammingError:
         logger.warning("Not dropping table as it does not exist")
     logger.debug("DB dropped all")
     logger.debug("DB create all")
-    db.create_all()
+    await create_tables()
     logger.debug("DB created all")
-    logger.debug("DB commit")
-    db.session.commit()
-    logger.debug("DB commited")
-
-
-def construct_payment_id(user_id, order_id):
-    """
-    Create payment ID for a certain user & order ID.
-    This just concatenates both IDs by a slash.
-    :param user_id: ID of user of payment
-    :param order_id: ID of order of payment
-    :return: ID of payment
-    """
-    return user_id + '/' + order_id
 
 
 @app.post('/create_user')
@@ -156,13 +118,37 @@ async def create_user():
     user_id = str(uuid.uuid4())
     user = User(user_id, 0)
 
-    db.session.add(user)
-    db.session.commit()
-    db.session.close()
+    async with Session() as session:
+        session.add(user)
+        await session.commit()
+    mark_written()
 
     return await make_response(jsonify({"user_id": user_id}), HTTPStatus.OK)
 
 
+@app.post('/batch_init/<n>/<starting_money>')
+@time(batch_init_metric)
+async def batch_init(n: int, starting_money: float):
+    """
+    Create n users with IDs 0 to n - 1 in a single statement, users that already exist are reset.
+    :param n: number of users
+    :param starting_money: credit of every user
+    :return: number of users
+    """
+    n = int(n)
+    statement = insert(User).from_select(
+        ['id', 'credit'],
+        select(cast(id_series(n), String), cast(literal(float(starting_money)), Float))
+    )
+    statement = statement.on_conflict_do_update(index_elements=[User.id], set_={'credit': statement.excluded.credit})
+
+    async with Session() as session:
+        await session.execute(statement)
+        await session.commit()
+
+    return await make_response(jsonify({"msg": "Batch init for users successful", "n": n}), HTTPStatus.OK)
+
+
 @app.get('/find_user/<user_id>')
 @time(find_user_metric)
 async def find_user(user_id: str):
@@ -171,7 +157,7 @@ async def find_user(user_id: str):
     :param user_id: ID of user to get information from
     :return: user object as User { id, credit }
     """
-    return User.query.get_or_404(user_id).as_dict()
+    return (await read_or_404(User, user_id)).as_dict()
 
 
 @app.post('/add_funds/<user_id>/<amount>')
@@ -183,16 +169,13 @@ async def add_credit(user_id: str, amount: float):
     :param amount: amount of funds to be added
     :return: true / false indicating success of update
     """
-    user = User.query.filter_by(id=user_id).first()
-    done = False
-    if bool(user):
-        user.credit = user.credit + float(amount)
-
-        db.session.add(user)
-        db.session.commit()
-        db.session.close()
-
-        done = True
+    async with Session() as session:
+        result = await session.execute(
+            update(User).where(User.id == user_id).values(credit=User.credit + float(amount)).returning(User.id)
+        )
+        done = result.scalar_one_or_none() is not None
+        await session.commit()
+    mark_written()
 
     return await make_response(jsonify({"done": done}), HTTPStatus.OK)
 
@@ -207,39 +190,7 @@ async def pay(user_id: str, order_id: str, amount: float):
     :param order_id: ID of order to which the amount corresponds
     :return: failure if credit is not enough
     """
-    return await remove_credit(amount, order_id, user_id)
-
-
-async def remove_credit(amount, order_id, user_id):
-    """
-    Subtracts the amount of the order from the user's credit.
-    :param amount: amount to be subtracted
-    :param user_id: ID of user to subtract credit from
-    :param order_id: ID of order to which the amount corresponds
-    :return: failure if credit is not enough
-    """
-    user = User.query.get_or_404(user_id)
-    logger.debug(f"removing credit from user: {user.as_dict() =}")
-    amount = float(amount)
-
-    if user.credit < amount:
-        logger.debug(f"Remove credit result no success, {user.credit = } is smaller than {amount =}")
-        return await make_response("Not enough credit", HTTPStatus.FORBIDDEN)
-
-    # Update credit
-    user.credit = user.credit - amount
-    db.session.add(user)
-
-    # Construct payment
-    payment_id = construct_payment_id(user_id, order_id)
-    payment = Payment(payment_id, user_id, order_id, amount, True)
-
-    db.session.add(payment)
-    db.session.commit()
-    db.session.close()
-
-    logger.debug(f"Remove credit result success")
-    return await make_response("Credit removed", HTTPStatus.OK)
+    return await respond(await remove_credit(amount, order_id, user_id))
 
 
 @app.post('/cancel/<user_id>/<order_id>')
@@ -251,35 +202,7 @@ async def cancel(user_id: str, order_id: str):
     :param order_id: ID of order to cancel the payment for
     :return: response indicating success of cancel payment
     """
-    return await cancel_payment(order_id, user_id)
-
-
-@time(cancel_payment_metric)
-async def cancel_payment(order_id, user_id):
-    """
-    Cancels the payment made by a specific user for a specific order.
-    :param user_id: ID of user to cancel the payment for
-    :param order_id: ID of order to cancel the payment for
-    :return: response indicating success of cancel payment
-    """
-    logger.debug(f"Cancelling payment for order: {order_id}")
-    user = User.query.get_or_404(user_id)
-
-    # Set paid to false
-    payment_id = construct_payment_id(user_id, order_id)
-    payment = Payment.query.get_or_404(payment_id)
-    payment.paid = False
-    db.session.add(payment)
-
-    # Add credit
-    user.credit = user.credit + payment.amount
-    db.session.add(user)
-
-    db.session.commit()
-    db.session.close()
-
-    logger.debug(f"Cancelled payment for order: {order_id}, db session closed and committed")
-    return await make_response("payment reset", HTTPStatus.OK)
+    return await respond(await cancel_payment(order_id, user_id))
 
 
 @app.post('/status/<user_id>/<order_id>')
@@ -293,7 +216,8 @@ async def payment_status(user_id: str, order_id: str):
     """
     paid = False
     payment_id = construct_payment_id(user_id, order_id)
-    payment = Payment.query.filter_by(id=payment_id).first()
+    async with read_session() as session:
+        payment = await session.get(Payment, payment_id)
 
     if bool(payment):
         paid = payment.paid
@@ -308,7 +232,7 @@ async def clear_tables():
     Clear all database tables of this service.
     :return: 200 if database tables were cleared
     """
-    recreate_tables()
+    await recreate_tables()
     return await make_response("tables cleared", HTTPStatus.OK)
 
 
@@ -318,6 +242,7 @@ def metrics():
     Get metrics of this service instance.
     :return: response object with metrics data
     """
+    sample_pools()
     data = generate_latest(registry)
     logger.debug(f"Metrics, returning: {data}")
     return Response(data, mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,15 @@
+import os
+import shutil
+
+from prometheus_client import CollectorRegistry, Summary, multiprocess
+
+PROMETHEUS_MULTIPROC_DIR = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+# make sure the dir is clean, before the first metric of the process is created in it
+shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+registry = CollectorRegistry()
+multiprocess.MultiProcessCollector(registry)
+
+# Metrics of the service layer, shared by the routes and the consumer
+cancel_payment_metric = Summary("db_cancel_payment", "cancel payment")
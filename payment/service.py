@@ -0,0 +1,258 @@
+import logging
+from dataclasses import dataclass
+from http import HTTPStatus
+from typing import Any, Optional
+
+from prometheus_async.aio import time
+from sqlalchemy import (
+    Boolean, CheckConstraint, Column, Float, String, exists, false, or_, select, update,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from database import Base, Session, mark_written
+from idempotency import get_processed, record_processed
+from metrics import cancel_payment_metric
+
+logger = logging.getLogger('payment-service')
+
+
+class User(Base):
+    __tablename__ = 'users'
+
+    id = Column(String(), primary_key=True)
+    credit = Column(Float, unique=False, nullable=False)
+    __table_args__ = (
+        CheckConstraint(credit >= 0, name='check_credit_positive'), {}
+    )
+
+    def __init__(self, id, credit):
+        """
+        User object containing all relevant fields.
+        :param id: ID of User
+        :param credit: Credit of User
+        """
+        self.id = id
+        self.credit = credit
+
+    def as_dict(self):
+        """
+        Convert object to a dictionary.
+        :return: dictionary of User object
+        """
+        dct: dict = self.__dict__.copy()
+        dct.pop('_sa_instance_state', None)
+        return dct
+
+
+class Payment(Base):
+    __tablename__ = 'payments'
+
+    id = Column(String(), primary_key=True)
+    user_id = Column(String(), unique=False, nullable=False)
+    order_id = Column(String(), unique=False, nullable=False)
+    amount = Column(Float, unique=False, nullable=False)
+    paid = Column(Boolean, unique=False, nullable=False)
+    # The credit is subtracted for a two-phase checkout that is not committed or aborted yet
+    prepared = Column(Boolean, unique=False, nullable=False, server_default=false())
+
+    def __init__(self, id, user_id, order_id, amount, paid, prepared=False):
+        """
+        Payment object containing all relevant fields.
+        :param id: ID of Payment
+        :param user_id: User doing the Payment
+        :param order_id: Order corresponding to Payment
+        :param amount: Price of the payment
+        :param paid: Status of payment
+        :param prepared: Whether the payment is prepared by a two-phase checkout
+        """
+        self.id = id
+        self.user_id = user_id
+        self.order_id = order_id
+        self.amount = amount
+        self.paid = paid
+        self.prepared = prepared
+
+    def as_dict(self):
+        """
+        Convert object to a dictionary.
+        :return: dictionary of Payment object
+        """
+        dct = self.__dict__.copy()
+        dct.pop('_sa_instance_state', None)
+        return dct
+
+
+@dataclass
+class Result:
+    """
+    Outcome of an operation of the payment service, sent as reply to a message or as response by a route.
+    """
+    status: HTTPStatus
+    # Text message, or a JSON object
+    body: Any
+
+
+def construct_payment_id(user_id, order_id):
+    """
+    Create payment ID for a certain user & order ID.
+    This just concatenates both IDs by a slash.
+    :param user_id: ID of user of payment
+    :param order_id: ID of order of payment
+    :return: ID of payment
+    """
+    return user_id + '/' + order_id
+
+
+async def remove_credit(amount, order_id, user_id, message_id: Optional[str] = None, prepare: bool = False) -> Result:
+    """
+    Subtracts the amount of the order from the user's credit.
+    The payment upsert, the credit check and the credit update are a single statement,
+    so concurrent payments of the same user can not overdraw the credit, and of concurrent payments of the same order
+    only one is debited.
+    :param amount: amount to be subtracted
+    :param user_id: ID of user to subtract credit from
+    :param order_id: ID of order to which the amount corresponds
+    :param message_id: ID of the message requesting the payment, a message that was processed before is not paid again
+    :param prepare: only prepare the payment of a two-phase checkout, it is paid by commit_payment
+    :return: failure if credit is not enough, 404 if the user does not exist
+    """
+    amount = float(amount)
+    payment_id = construct_payment_id(user_id, order_id)
+
+    # Record the payment, a payment that was cancelled before is paid again. A conflicting payment is locked and
+    # checked in its latest version, so only one of concurrent payments of the same order changes it.
+    recorded = insert(Payment).values(
+        id=payment_id, user_id=user_id, order_id=order_id, amount=amount, paid=not prepare, prepared=prepare
+    )
+    recorded = recorded.on_conflict_do_update(
+        index_elements=[Payment.id],
+        set_={Payment.amount: recorded.excluded.amount, Payment.paid: not prepare, Payment.prepared: prepare},
+        where=~or_(Payment.paid, Payment.prepared)
+    ).returning(Payment.id).cte('recorded')
+
+    # Only subtract the credit for a payment that was recorded, and if it is enough.
+    # Otherwise the transaction is rolled back, which drops the recorded payment again.
+    statement = update(User).where(
+        User.id == user_id,
+        User.credit >= amount,
+        exists(select(recorded.c.id))
+    ).values(credit=User.credit - amount).returning(User.id)
+
+    async with Session() as session:
+        if message_id is not None:
+            processed = await get_processed(session, message_id)
+            if processed is not None:
+                logger.debug(f"Message {message_id} was already processed")
+                return Result(HTTPStatus(processed.status), processed.body)
+
+        try:
+            result = await session.execute(statement)
+            paid = result.scalar_one_or_none() is not None
+            if not paid:
+                await session.rollback()
+            else:
+                if message_id is not None:
+                    await record_processed(session, message_id, HTTPStatus.OK, "Credit removed")
+                await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            processed = await get_processed(session, message_id) if message_id is not None else None
+            if processed is None:
+                raise
+            logger.debug(f"Message {message_id} was processed concurrently")
+            return Result(HTTPStatus(processed.status), processed.body)
+
+        if not paid:
+            user = await session.get(User, user_id)
+            if user is None:
+                return Result(HTTPStatus.NOT_FOUND, "User not found")
+            payment = await session.get(Payment, payment_id)
+            if payment is not None and (payment.paid or payment.prepared):
+                logger.debug(f"Remove credit result no success, order {order_id} is already paid")
+                message, status = "Order already paid", HTTPStatus.BAD_REQUEST
+            else:
+                logger.debug(f"Remove credit result no success, {user.credit = } is smaller than {amount =}")
+                message, status = "Not enough credit", HTTPStatus.FORBIDDEN
+
+            # Failures are remembered as well, so a redelivery can not succeed after the order has given up
+            if message_id is not None:
+                await record_processed(session, message_id, status, message, ignore_duplicate=True)
+                await session.commit()
+            return Result(status, message)
+    mark_written()
+
+    logger.debug("Remove credit result success")
+    return Result(HTTPStatus.OK, "Credit removed")
+
+
+@time(cancel_payment_metric)
+async def cancel_payment(order_id, user_id, message_id: Optional[str] = None, prepared: bool = False) -> Result:
+    """
+    Cancels the payment made by a specific user for a specific order.
+    :param user_id: ID of user to cancel the payment for
+    :param order_id: ID of order to cancel the payment for
+    :param message_id: ID of the message requesting the cancel, a message that was processed before is not applied again
+    :param prepared: cancel the prepared payment of an aborted two-phase checkout instead of a paid one
+    :return: result indicating success of cancel payment, 404 if the user or payment does not exist
+    """
+    logger.debug(f"Cancelling payment for order: {order_id}")
+    payment_id = construct_payment_id(user_id, order_id)
+
+    # Reset the state, only if it is set so the credit is never refunded twice
+    state = Payment.prepared if prepared else Payment.paid
+    refunded = update(Payment).where(
+        Payment.id == payment_id, state
+    ).values({state: False}).returning(Payment.user_id, Payment.amount).cte('refunded')
+
+    # Add credit
+    statement = update(User).where(
+        User.id == refunded.c.user_id
+    ).values(credit=User.credit + refunded.c.amount).returning(User.id)
+
+    async with Session() as session:
+        if message_id is not None:
+            processed = await get_processed(session, message_id)
+            if processed is not None:
+                logger.debug(f"Message {message_id} was already processed")
+                return Result(HTTPStatus(processed.status), processed.body)
+
+        result = await session.execute(statement)
+        done = result.scalar_one_or_none() is not None
+        if not done:
+            # Not remembered, so a cancel that overtook its payment is applied when it is sent again
+            if await session.get(User, user_id) is None:
+                return Result(HTTPStatus.NOT_FOUND, "User not found")
+            if await session.get(Payment, payment_id) is None:
+                return Result(HTTPStatus.NOT_FOUND, "Payment not found")
+            logger.debug(f"Payment for order: {order_id} was already cancelled")
+        if message_id is not None:
+            await record_processed(session, message_id, HTTPStatus.OK, "payment reset", ignore_duplicate=True)
+        await session.commit()
+    mark_written()
+
+    logger.debug(f"Cancelled payment for order: {order_id}, db session closed and committed")
+    return Result(HTTPStatus.OK, "payment reset")
+
+
+async def commit_payment(order_id, user_id) -> Result:
+    """
+    Pay the prepared payment of a committed two-phase checkout, its credit is subtracted already.
+    :param user_id: ID of user of the payment
+    :param order_id: ID of order of the payment
+    :return: result indicating success, 404 if the payment is neither prepared nor paid
+    """
+    payment_id = construct_payment_id(user_id, order_id)
+    async with Session() as session:
+        result = await session.execute(update(Payment).where(
+            Payment.id == payment_id, Payment.prepared
+        ).values(paid=True, prepared=False))
+        await session.commit()
+
+        if result.rowcount == 0:
+            payment = await session.get(Payment, payment_id)
+            if payment is None or not payment.paid:
+                return Result(HTTPStatus.NOT_FOUND, "Payment not prepared")
+            logger.debug(f"Payment for order: {order_id} was already committed")
+    mark_written()
+    return Result(HTTPStatus.OK, "Payment committed")
@@ -1,19 +1,29 @@
-import json
+import asyncio
 import logging
 import os
-import shutil
 import uuid
 from http import HTTPStatus
-from typing import Dict
+from typing import Optional
 
-import sqlalchemy.exc
-from flask_sqlalchemy import SQLAlchemy
 from prometheus_async.aio import time
-from prometheus_client import CollectorRegistry, multiprocess, generate_latest, CONTENT_TYPE_LATEST, Summary
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, Summary
 from quart import Quart, make_response, jsonify, Response, request
-from sqlalchemy import CheckConstraint, case
+from sqlalchemy import Float, Integer, String, cast, delete, literal, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import ProgrammingError
 
+from database import (
+    Session, create_tables, drop_tables, id_series, instrument_pool, mark_written, sample_pools, sticky_reads,
+)
+from idempotency import expire_processed_messages
+from metrics import registry
+from runtime import ConsumerRuntime
+from service import (
+    RESERVATION_TTL, Item, ItemSlot, Result, change_stock, commit_reservation, decrease_items, find_item as read_item,
+    increase_items as increase_stock, item_quantities, release_reservation, reserve_items, split_item,
+    sweep_reservations,
+)
+
 app_name = 'stock-service'
 app = Quart(app_name)
 
@@ -24,24 +34,16 @@ logger = logging.getLogger(app_name)
 
 payment_url = f"http://{os.environ['PAYMENT_SERVICE_URL']}"
 
-DB_URL = 'postgresql+psycopg2://{user}:{pw}@{host}/{db}' \
-    .format(user=os.environ['POSTGRES_USER'],
-            pw=os.environ['POSTGRES_PASSWORD'],
-            host=os.environ['POSTGRES_HOST'],
-            db=os.environ['POSTGRES_DB'])
-
-app.config['SQLALCHEMY_DATABASE_URI'] = DB_URL
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # silence the deprecation warning
-
-db = SQLAlchemy(app)
+# Consume the queue of the service in the app process, sharing the database pool and metrics with the routes,
+# instead of running consumer.py in a separate deployment
+CONSUMER_IN_APP = os.environ.get('CONSUMER_IN_APP', 'false').lower() == 'true'
+consumer: Optional[ConsumerRuntime] = None
+consumer_task: Optional[asyncio.Task] = None
+message_expiry: Optional[asyncio.Task] = None
+reservation_sweeper: Optional[asyncio.Task] = None
 
-PROMETHEUS_MULTIPROC_DIR = os.environ["PROMETHEUS_MULTIPROC_DIR"]
-# make sure the dir is clean
-shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
-os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
-
-registry = CollectorRegistry()
-multiprocess.MultiProcessCollector(registry)
+instrument_pool()
+sticky_reads(app)
 
 
 create_item_metric = Summary("create_item", "Summary of /item/create/<price> endpoint")
@@ -50,69 +52,72 @@ add_stock_metric = Summary("add_stock", "Summary of /add/<item_id>/<amount>")
 remove_stock_metric = Summary("remove_stock", "/subtract/<item_id>/<amount>")
 increase_items_metric = Summary("increase_items", "/increaseItems/")
 subtract_items_metric = Summary("decrease_items", "/decreaseItems/")
-update_stock_db_metric = Summary("db_update_stock", "updateStock function")
+reserve_items_metric = Summary("reserve_items", "/reserve/<reservation_id>")
+commit_reservation_metric = Summary("commit_reservation", "/commit/<reservation_id>")
+release_reservation_metric = Summary("release_reservation", "/release/<reservation_id>")
+split_item_metric = Summary("split_item", "Summary of /split/<item_id>/<slots>")
+batch_init_metric = Summary("batch_init", "Summary of /batch_init/<n>/<starting_stock>/<item_price>")
 
 
-class Item(db.Model):
-    __tablename__ = 'items'
+async def respond(result: Result):
+    """
+    Create the response of a route from the result of the service layer.
+    :param result: result of the operation
+    :return: response with the body and status code of the result
+    """
+    body = jsonify(result.body) if isinstance(result.body, dict) else result.body
+    return await make_response(body, result.status)
 
-    id = db.Column(db.String, primary_key=True)
-    price = db.Column(db.Float, unique=False, nullable=False)
-    stock = db.Column(db.Integer, unique=False, nullable=False)
-    __table_args__ = (
-        CheckConstraint(stock >= 0, name='check_stock_positive'), {}
-    )
 
-    def __init__(self, id, price, stock):
-        """
-        Item object containing all relevant fields.
-        :param id: ID of item
-        :param price: Price of the item
-        :param stock: Amount of stock left for the item
-        """
-        self.id = id
-        self.price = price
-        self.stock = stock
-
-    def __repr__(self):
-        """
-        Representing an instance of this entity with a string containing ID.
-        :return: string containing ID
-        """
-        return '<id {}>'.format(self.id)
-
-    def as_dict(self):
-        """
-        Convert object to a dictionary.
-        :return: dictionary of Item object
-        """
-        dct = self.__dict__.copy()
-        dct.pop('_sa_instance_state', None)
-        return dct
-
-
-# Create all needed tables in database.
-db.create_all()
-db.session.commit()
-
-
-def recreate_tables():
+@app.before_serving
+async def startup():
+    """
+    Create all needed tables in database, and start consuming the queue of the service if CONSUMER_IN_APP is set.
+    """
+    global consumer, consumer_task, message_expiry, reservation_sweeper
+    await create_tables()
+    if CONSUMER_IN_APP:
+        # The consumer imports the app for its process setup, so it can only be imported once the app is loaded
+        from consumer import create_runtime
+        consumer = create_runtime()
+        consumer_task = asyncio.create_task(consumer.run(handle_signals=False))
+        consumer_task.add_done_callback(consumer_stopped)
+        message_expiry = asyncio.create_task(expire_processed_messages())
+        reservation_sweeper = asyncio.create_task(sweep_reservations())
+
+
+@app.after_serving
+async def shutdown():
+    """
+    Stop consuming and wait for the messages being processed.
+    """
+    if message_expiry is not None:
+        message_expiry.cancel()
+    if reservation_sweeper is not None:
+        reservation_sweeper.cancel()
+    if consumer_task is not None:
+        consumer.stop()
+        await asyncio.wait([consumer_task])
+
+
+def consumer_stopped(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Consuming the queue failed", exc_info=task.exception())
+
+
+async def recreate_tables():
     """
     Recreate all tables in the database.
     """
     logger.debug("DB drop all")
     try:
-        db.session.close()
-        db.drop_all()
+        await drop_tables()
     except ProgrammingError:
         logger.warning("Not dropping table as it does not exist")
     logger.debug("DB dropped all")
     logger.debug("DB create all")
-    db.create_all()
+    await create_tables()
     logger.debug("DB created all")
-    logger.debug("DB commit")
-    db.session.commit()
-    logger.debug("DB committed")
 
 
 @app.post('/item/create/<price>')
@@ -127,13 +132,42 @@ async def create_item(price: float):
     item = Item(item_id, float(price), 0)
     logger.debug(f"Adding item {item.as_dict()} to db")
 
-    db.session.add(item)
-    db.session.commit()
-    db.session.close()
+    async with Session() as session:
+        session.add(item)
+        await session.commit()
+    mark_written()
 
     return await make_response(jsonify({"item_id": item_id}), HTTPStatus.OK)
 
 
+@app.post('/batch_init/<n>/<starting_stock>/<item_price>')
+@time(batch_init_metric)
+async def batch_init(n: int, starting_stock: int, item_price: float):
+    """
+    Create n items with IDs 0 to n - 1 in a single statement, items that already exist get their stock reset.
+    Their price is kept, the order service caches prices without invalidation.
+    :param n: number of items
+    :param starting_stock: stock of every item
+    :param item_price: price of every item
+    :return: number of items
+    """
+    n = int(n)
+    i = id_series(n)
+    statement = insert(Item).from_select(
+        ['id', 'price', 'stock'],
+        select(cast(i, String), cast(literal(float(item_price)), Float), cast(literal(int(starting_stock)), Integer))
+    )
+    statement = statement.on_conflict_do_update(index_elements=[Item.id], set_={'stock': statement.excluded.stock})
+
+    async with Session() as session:
+        # The stock of split items is reset as well
+        await session.execute(delete(ItemSlot).where(ItemSlot.item_id.in_(select(cast(i, String)))))
+        await session.execute(statement)
+        await session.commit()
+
+    return await make_response(jsonify({"msg": "Batch init for stock successful", "n": n}), HTTPStatus.OK)
+
+
 @app.get('/find/<item_id>')
 @time(find_item_metric)
 async def find_item(item_id: str):
@@ -143,19 +177,9 @@ async def find_item(item_id: str):
     :return: item object as Item { id, stock, price }
     """
     logger.debug(f"Finding: {item_id=}")
-    item = Item.query.get_or_404(item_id).as_dict()
-    logger.debug(f"Found: {item}")
-    return item
-
-
-async def get_item_price(item_id: str):
-    """
-    Get price of a certain item.
-    :param item_id: ID of item
-    :return: price of item
-    """
-    item = Item.query.get_or_404(item_id).as_dict()
-    return await make_response(json.dumps({"price": item["price"]}), HTTPStatus.OK)
+    result = await read_item(item_id)
+    logger.debug(f"Found: {result.body}")
+    return await respond(result)
 
 
 @app.post('/add/<item_id>/<amount>')
@@ -167,13 +191,10 @@ async def add_stock(item_id: str, amount: int):
     :param amount: amount of items to be added
     :return: response indicating success of update
     """
-    item = Item.query.get_or_404(item_id)
-    item.stock = item.stock + int(amount)
-
-    db.session.add(item)
-    db.session.commit()
-    db.session.close()
-
+    # Through the stock updates, so the stock of a split item is added to one of its slots
+    result = await change_stock({item_id: int(amount)})
+    if result.status != HTTPStatus.OK:
+        return await respond(result)
     return await make_response("Stock added", HTTPStatus.OK)
 
 
@@ -187,60 +208,33 @@ async def remove_stock(item_id: str, amount: int):
     :return: response indicating success of update
     """
     logger.debug(f"Attempting to take {amount} from stock of {item_id=}")
-    return await update_stock({item_id: Item.stock - int(amount)})
+    return await respond(await change_stock({item_id: -int(amount)}))
 
 
-@time(update_stock_db_metric)
-async def update_stock(amounts: Dict[str, int]):
+@app.post('/split/<item_id>/<slots>')
+@time(split_item_metric)
+async def split(item_id: str, slots: int):
     """
-    Update the stock in the database
-    If the stock goes below zero, the db will throw an integrity error
-    :param amounts: amount dictionary of items with corresponding amount to be updated
-    :return: response indicating success of update
+    Spread the stock of a popular item over a number of rows, so concurrent checkouts of it update different rows.
+    Only used for stock updates with STOCK_SPLIT_COUNTERS enabled.
+    :param item_id: ID of the item
+    :param slots: number of slots, 1 merges the stock back into the item
+    :return: response indicating success, 404 if the item does not exist
     """
-    if len(amounts) <= 0:
-        logger.warning("Items subtract call with no items")
-        message = "No items in request"
-        return await make_response(message, HTTPStatus.OK)
-
-    try:
-        items_affected = db.session.query(Item).filter(
-            Item.id.in_(amounts)
-        ).update({Item.stock: case(
-            amounts,
-            value=Item.id
-        )})
-
-        db.session.commit()
-    except sqlalchemy.exc.IntegrityError:
-        logger.debug(f"Violated constraint for item when subtracting items")
-        message = "Not enough stock"
-        response = await make_response(message, HTTPStatus.BAD_REQUEST)
-        db.session.rollback()
-    else:
-        if items_affected != len(amounts):
-            message = "Stock subtracting failed for at least 1 item"
-            response = await make_response(message, HTTPStatus.BAD_REQUEST)
-        else:
-            message = "stock subtracted"
-            response = await make_response(message, HTTPStatus.OK)
-
-    logger.debug(f"Update stock response {message}, : {response.status_code}")
-
-    db.session.close()
-    return response
+    return await respond(await split_item(item_id, int(slots)))
 
 
 @app.post('/subtractItems/')
 @time(subtract_items_metric)
 async def subtract_items():
     """
-    Subtracts all items in the list from stock by the amount of 1
-    Pass in an 'items_ids" array as JSON in the POST request.
+    Subtracts the quantity of every item from its stock.
+    Pass in an 'items' object of quantities by item ID as JSON in the POST request.
     :return: response indicating success of update
     """
-    logger.debug(f"Subtract the items for request: {request.json =}")
-    return await update_stock({id_: Item.stock - 1 for id_ in request.json['item_ids']})
+    request_body = await request.get_json()
+    logger.debug(f"Subtract the items for request: {request_body =}")
+    return await respond(await decrease_items(item_quantities(request_body)))
 
 
 @app.post('/increaseItems/')
@@ -248,12 +242,53 @@ async def subtract_items():
 async def increase_items():
     """
     This is a rollback function. Following the SAGA pattern.
-    Increases all items in the list from stock by the amount of 1
-    Pass in an 'items_ids" array as JSON in the POST request.
+    Increases the stock of every item by its quantity.
+    Pass in an 'items' object of quantities by item ID as JSON in the POST request.
     :return: response indicating success of update
     """
-    logger.debug(f"Increase the items for request: {request.json =}")
-    return await update_stock({id_: Item.stock + 1 for id_ in request.json['item_ids']})
+    request_body = await request.get_json()
+    logger.debug(f"Increase the items for request: {request_body =}")
+    return await respond(await increase_stock(item_quantities(request_body)))
+
+
+@app.post('/reserve/<reservation_id>')
+@time(reserve_items_metric)
+async def reserve(reservation_id: str):
+    """
+    Subtracts the quantity of every item from its available stock and holds it for a new reservation,
+    until it is committed or released, or expires.
+    Pass in an 'items' object of quantities by item ID as JSON in the POST request, and optionally the seconds until
+    the reservation expires as 'reservation_ttl' (RESERVATION_TTL by default).
+    :param reservation_id: unique ID of the reservation
+    :return: response indicating success of the reservation
+    """
+    request_body = await request.get_json()
+    logger.debug(f"Reserve the items for reservation {reservation_id}: {request_body =}")
+    ttl = float(request_body.get('reservation_ttl', RESERVATION_TTL))
+    return await respond(await reserve_items(reservation_id, item_quantities(request_body), ttl=ttl))
+
+
+@app.post('/commit/<reservation_id>')
+@time(commit_reservation_metric)
+async def commit(reservation_id: str):
+    """
+    Finalize a reservation, its stock stays subtracted.
+    :param reservation_id: ID of the reservation
+    :return: response indicating success, 404 if the reservation is not held, 410 if it expired
+    """
+    return await respond(await commit_reservation(reservation_id))
+
+
+@app.post('/release/<reservation_id>')
+@time(release_reservation_metric)
+async def release(reservation_id: str):
+    """
+    This is a rollback function. Following the SAGA pattern.
+    Release a reservation, its stock is returned to the items by the sweeper.
+    :param reservation_id: ID of the reservation
+    :return: response indicating success, 404 if the reservation is not held
+    """
+    return await respond(await release_reservation(reservation_id))
 
 
 @app.delete('/clear_tables')
@@ -262,7 +297,7 @@ async def clear_tables():
     Clear all database tables of this service.
     :return: 200 if database tables were cleared
     """
-    recreate_tables()
+    await recreate_tables()
     return await make_response("tables cleared", HTTPStatus.OK)
 
 
@@ -272,6 +307,7 @@ def metrics():
     Get metrics of this service instance.
     :return: response object with metrics data
     """
+    sample_pools()
     data = generate_latest(registry)
     logger.debug(f"Metrics, returning: {data}")
     return Response(data, mimetype=CONTENT_TYPE_LATEST)
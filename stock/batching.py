@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+
+class Batcher:
+    """
+    Collects requests submitted concurrently and applies them together in one batch.
+    A batch is applied once it holds max_size requests or linger seconds after its first request.
+    If applying a batch fails as a whole (e.g. a deadlock), every request of it is applied on its own instead.
+    """
+
+    def __init__(self, apply_batch: Callable[[List[Tuple]], Awaitable[List[Any]]],
+                 apply_one: Callable[..., Awaitable[Any]], max_size: int, linger: float) -> None:
+        """
+        :param apply_batch: coroutine function applying a list of requests, returning a result per request
+        :param apply_one: coroutine function applying a single request
+        :param max_size: maximum number of requests in one batch
+        :param linger: seconds to wait for more requests before applying a batch
+        """
+        self.apply_batch = apply_batch
+        self.apply_one = apply_one
+        self.max_size = max_size
+        self.linger = linger
+        self.pending: List[Tuple[Tuple, asyncio.Future]] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, *request):
+        """
+        Add a request to the next batch and wait for its result.
+        :param request: arguments of the request
+        :return: result of the request
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((request, future))
+
+        if len(self.pending) >= self.max_size:
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.linger, self.flush)
+        return await asyncio.shield(future)
+
+    def flush(self):
+        self.flush_handle = None
+        batch, self.pending = self.pending, []
+        asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch: List[Tuple[Tuple, asyncio.Future]]):
+        """
+        Apply a batch and complete the futures of its requests.
+        :param batch: requests and their futures
+        """
+        try:
+            results = await self.apply_batch([request for request, _ in batch])
+        except Exception:
+            logging.exception(f"Applying batch of {len(batch)} failed, applying requests one by one")
+            await asyncio.gather(*(self.run_one(request, future) for request, future in batch))
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def run_one(self, request: Tuple, future: asyncio.Future):
+        try:
+            result = await self.apply_one(*request)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,88 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+import msgpack
+
+# Codec of the messages this process sends, replies are encoded with the codec of the request
+MESSAGE_CODEC = os.environ.get('MESSAGE_CODEC', 'msgpack')
+
+
+class Codec(ABC):
+    """
+    Serialization of message bodies, identified by the AMQP content type of the messages.
+    """
+    name: str
+    content_type: str
+
+    @abstractmethod
+    def encode(self, payload: Any) -> bytes:
+        """
+        Encode the body of a message.
+        """
+
+    @abstractmethod
+    def decode(self, body: bytes) -> Any:
+        """
+        Decode the body of a received message.
+        """
+
+
+class JsonCodec(Codec):
+    """
+    Text JSON, readable in the RabbitMQ management UI for debugging.
+    """
+    name = 'json'
+    content_type = 'application/json'
+
+    def encode(self, payload: Any) -> bytes:
+        return json.dumps(payload, separators=(',', ':')).encode()
+
+    def decode(self, body: bytes) -> Any:
+        return json.loads(body)
+
+
+class MsgpackCodec(Codec):
+    """
+    Binary MessagePack, smaller and faster to encode and decode than JSON for large carts.
+    """
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def encode(self, payload: Any) -> bytes:
+        return msgpack.packb(payload)
+
+    def decode(self, body: bytes) -> Any:
+        return msgpack.unpackb(body)
+
+
+CODECS: Dict[str, Codec] = {codec.content_type: codec for codec in (JsonCodec(), MsgpackCodec())}
+
+
+def get_codec(content_type: Optional[str]) -> Codec:
+    """
+    Get the codec of a received message.
+    :param content_type: content type of the message, messages without one are JSON
+    :return: the codec
+    :raises ValueError: if the content type is not supported
+    """
+    if content_type is None:
+        return CODECS[JsonCodec.content_type]
+    try:
+        return CODECS[content_type]
+    except KeyError:
+        raise ValueError(f"Unsupported content type {content_type}") from None
+
+
+def codec_by_name(name: str) -> Codec:
+    """
+    Get a codec by its name, e.g. MESSAGE_CODEC.
+    :param name: json or msgpack
+    :return: the codec
+    :raises ValueError: if there is no codec with the name
+    """
+    for codec in CODECS.values():
+        if codec.name == name:
+            return codec
+    raise ValueError(f"Unknown codec {name}, expected one of {[codec.name for codec in CODECS.values()]}")
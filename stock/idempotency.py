@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import Column, DateTime, SmallInteger, Text, delete, func, select
+from sqlalchemy.dialects.postgresql import UUID, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Base, Session
+
+# How long processed messages are remembered, a redelivery after this is processed again
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_CLEANUP_INTERVAL = float(os.environ.get('IDEMPOTENCY_CLEANUP_INTERVAL', 60))
+
+MESSAGE_ID_NAMESPACE = uuid.UUID('0f6b5a3e-6c55-4a8e-9d2f-2b8f4c1e7a90')
+
+
+class ProcessedMessage(Base):
+    """
+    Reply to a message that has been processed, so a redelivery of the message gets the same reply
+    instead of being applied twice. Message IDs are stored as UUIDs to keep the table and its index small.
+    """
+    __tablename__ = 'processed_messages'
+
+    id = Column(UUID(as_uuid=True), primary_key=True)
+    status = Column(SmallInteger, nullable=False)
+    body = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
+
+
+def message_key(message_id: str) -> uuid.UUID:
+    """
+    Convert a message ID of any length to a compact key.
+    :param message_id: ID of message
+    :return: UUID of message
+    """
+    return uuid.uuid5(MESSAGE_ID_NAMESPACE, message_id)
+
+
+async def get_processed(session: AsyncSession, message_id: str) -> Optional[ProcessedMessage]:
+    """
+    Get the stored reply of a message if it has been processed before.
+    :param session: session to query with
+    :param message_id: ID of message
+    :return: the processed message, None if it has not been processed
+    """
+    result = await session.execute(select(ProcessedMessage).where(ProcessedMessage.id == message_key(message_id)))
+    return result.scalar_one_or_none()
+
+
+async def get_processed_many(session: AsyncSession, message_ids: List[str]) -> Dict[str, ProcessedMessage]:
+    """
+    Get the stored replies of multiple messages in a single query.
+    :param session: session to query with
+    :param message_ids: IDs of messages
+    :return: processed messages by message ID, messages that have not been processed are left out
+    """
+    if not message_ids:
+        return {}
+    keys = {message_key(message_id): message_id for message_id in message_ids}
+    result = await session.execute(select(ProcessedMessage).where(ProcessedMessage.id.in_(keys)))
+    return {keys[processed.id]: processed for processed in result.scalars()}
+
+
+async def record_processed(session: AsyncSession, message_id: str, status: int, body: str, ignore_duplicate=False):
+    """
+    Store the reply of a processed message, in the same transaction as the effects of the message.
+    If the message was processed concurrently, this raises an IntegrityError so the transaction can be rolled back.
+    :param session: session of the transaction processing the message
+    :param message_id: ID of message
+    :param status: status code of the reply
+    :param body: body of the reply
+    :param ignore_duplicate: don't raise if the message was processed concurrently, for messages without effects
+    """
+    statement = insert(ProcessedMessage).values(id=message_key(message_id), status=int(status), body=body)
+    if ignore_duplicate:
+        statement = statement.on_conflict_do_nothing(index_elements=[ProcessedMessage.id])
+    await session.execute(statement)
+
+
+async def expire_processed_messages():
+    """
+    Periodically delete processed messages older than IDEMPOTENCY_TTL.
+    """
+    while True:
+        try:
+            async with Session() as session:
+                result = await session.execute(delete(ProcessedMessage).where(
+                    ProcessedMessage.created_at < func.now() - timedelta(seconds=IDEMPOTENCY_TTL)
+                ))
+                await session.commit()
+            logging.debug(f"Deleted {result.rowcount} expired processed messages")
+        except Exception:
+            logging.exception("Deleting expired processed messages failed")
+        await asyncio.sleep(IDEMPOTENCY_CLEANUP_INTERVAL)
@@ -0,0 +1,21 @@
+import os
+import shutil
+
+from prometheus_client import CollectorRegistry, Counter, Summary, multiprocess
+
+PROMETHEUS_MULTIPROC_DIR = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+# make sure the dir is clean, before the first metric of the process is created in it
+shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+registry = CollectorRegistry()
+multiprocess.MultiProcessCollector(registry)
+
+# Metrics of the service layer, shared by the routes and the consumer
+update_stock_db_metric = Summary("db_update_stock", "updateStock function")
+update_stock_batch_metric = Summary("db_update_stock_batch", "updateStockBatch function")
+transaction_retries = Counter("db_transaction_retries",
+                              "Transactions run again after a deadlock or serialization failure", ["transaction"])
+holds_returned = Counter("reservation_holds_returned",
+                         "Released or expired holds whose stock was returned to the items")
+reservation_commits_expired = Counter("reservation_commits_expired", "Commits refused because the reservation expired")
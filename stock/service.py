@@ -0,0 +1,611 @@
+import asyncio
+import logging
+import os
+from collections import Counter
+from dataclasses import dataclass
+from datetime import timedelta
+from http import HTTPStatus
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import sqlalchemy.exc
+from prometheus_async.aio import time
+from sqlalchemy import (
+    Boolean, CheckConstraint, Column, DateTime, Float, Integer, String, case, delete, false, func, insert, or_, select,
+    tuple_, update,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import (
+    Base, Session, engine, mark_written, read_entity, read_session, replica_engine, retry_on_conflict,
+)
+from idempotency import get_processed, get_processed_many, record_processed
+from metrics import (
+    holds_returned, reservation_commits_expired, transaction_retries, update_stock_batch_metric, update_stock_db_metric,
+)
+
+logger = logging.getLogger('stock-service')
+
+# Seconds a reservation is held if the reserve message does not say, before the sweeper returns its stock
+RESERVATION_TTL = float(os.environ.get('RESERVATION_TTL', 600))
+# Seconds an expired hold is kept after its stock was returned, so a late commit learns that it expired
+RESERVATION_EXPIRED_RETENTION = float(os.environ.get('RESERVATION_EXPIRED_RETENTION', 24 * 60 * 60))
+# Seconds between the rounds of the sweeper, and the most holds it returns in one round
+RESERVATION_SWEEP_INTERVAL = float(os.environ.get('RESERVATION_SWEEP_INTERVAL', 1))
+RESERVATION_SWEEP_BATCH = int(os.environ.get('RESERVATION_SWEEP_BATCH', 1000))
+# Look up which items have their stock split over slots (see ItemSlot) when updating the stock,
+# off by default to save the lookup when no item is split
+STOCK_SPLIT_COUNTERS = os.environ.get('STOCK_SPLIT_COUNTERS', 'false').lower() == 'true'
+
+
+class Item(Base):
+    __tablename__ = 'items'
+
+    id = Column(String, primary_key=True)
+    price = Column(Float, unique=False, nullable=False)
+    stock = Column(Integer, unique=False, nullable=False)
+    __table_args__ = (
+        CheckConstraint(stock >= 0, name='check_stock_positive'), {}
+    )
+
+    def __init__(self, id, price, stock):
+        """
+        Item object containing all relevant fields.
+        :param id: ID of item
+        :param price: Price of the item
+        :param stock: Amount of stock left for the item
+        """
+        self.id = id
+        self.price = price
+        self.stock = stock
+
+    def __repr__(self):
+        """
+        Representing an instance of this entity with a string containing ID.
+        :return: string containing ID
+        """
+        return '<id {}>'.format(self.id)
+
+    def as_dict(self):
+        """
+        Convert object to a dictionary.
+        :return: dictionary of Item object
+        """
+        dct = self.__dict__.copy()
+        dct.pop('_sa_instance_state', None)
+        return dct
+
+
+class ItemSlot(Base):
+    """
+    Part of the stock of an item that is split over slots, so concurrent checkouts of a popular item update different
+    rows instead of queueing for the lock of its row. The stock of the item is its Item.stock (0 once it is split)
+    plus the stock of all its slots.
+    """
+    __tablename__ = 'item_slots'
+
+    item_id = Column(String, primary_key=True)
+    slot = Column(Integer, primary_key=True)
+    stock = Column(Integer, nullable=False)
+    __table_args__ = (
+        CheckConstraint(stock >= 0, name='check_slot_stock_positive'), {}
+    )
+
+
+class Reservation(Base):
+    """
+    Hold of the stock of one item by a reservation. The stock is subtracted from the item when the hold is created,
+    so Item.stock is the stock available to new reservations. Committing the reservation deletes its holds, releasing
+    it marks them released, the sweeper then returns their stock together with the stock of other released holds.
+    A hold that is neither committed nor released by expires_at is returned by the sweeper as well. It is kept as
+    returned, so committing it fails instead of selling its stock twice, until it is released or
+    RESERVATION_EXPIRED_RETENTION has passed.
+    """
+    __tablename__ = 'reservations'
+
+    id = Column(String, primary_key=True)
+    item_id = Column(String, primary_key=True)
+    quantity = Column(Integer, nullable=False)
+    released = Column(Boolean, nullable=False, server_default=false())
+    # Whether the sweeper returned the stock of the hold, because it was released or expired
+    returned = Column(Boolean, nullable=False, server_default=false())
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    expires_at = Column(DateTime, nullable=False)
+
+
+@dataclass
+class Hold:
+    """
+    Quantities of items to hold for a reservation, in the transaction subtracting them.
+    """
+    reservation_id: str
+    quantities: Dict[str, int]
+    # Seconds until the holds expire
+    ttl: float = RESERVATION_TTL
+
+
+@dataclass
+class Result:
+    """
+    Outcome of an operation of the stock service, sent as reply to a message or as response by a route.
+    """
+    status: HTTPStatus
+    # Text message, or a JSON object
+    body: Any
+
+
+def update_stock_statement(deltas: Dict[str, int]):
+    """
+    Create the statement updating the stock of all items in a single UPDATE.
+    :param deltas: amount to add to the stock by item ID, negative to subtract
+    :return: update statement
+    """
+    return update(Item).where(
+        Item.id.in_(deltas)
+    ).values({Item.stock: case(
+        {item_id: Item.stock + delta for item_id, delta in deltas.items()},
+        value=Item.id
+    )}).execution_options(synchronize_session=False)
+
+
+async def lock_items(session: AsyncSession, item_ids: Iterable[str]):
+    """
+    Lock the rows of items in the order of their IDs. Transactions updating overlapping sets of items then wait for
+    each other instead of deadlocking, which they can when an UPDATE locks the rows in the order it finds them.
+    :param session: session of the transaction updating the items
+    :param item_ids: IDs of the items
+    """
+    await session.execute(
+        select(Item.id).where(Item.id.in_(sorted(item_ids))).order_by(Item.id).with_for_update()
+    )
+
+
+async def split_items(session: AsyncSession, item_ids: Iterable[str]) -> Set[str]:
+    """
+    Find the items whose stock is split over slots, if STOCK_SPLIT_COUNTERS is enabled.
+    :param session: session of the transaction updating the items
+    :param item_ids: IDs of the items
+    :return: IDs of the split items
+    """
+    if not STOCK_SPLIT_COUNTERS:
+        return set()
+    result = await session.execute(select(ItemSlot.item_id).where(ItemSlot.item_id.in_(list(item_ids))).distinct())
+    return set(result.scalars())
+
+
+async def change_slots(session: AsyncSession, item_id: str, delta: int) -> bool:
+    """
+    Update the stock of a split item. A random slot that is not locked by another transaction and has enough stock
+    is updated, otherwise the stock is taken from all slots in order, waiting for their locks.
+    If the slots together do not have enough stock either, the check constraint of the last slot fails.
+    :param session: session of the transaction updating the item
+    :param item_id: ID of the item
+    :param delta: amount to add to the stock, negative to subtract
+    :return: whether the item is (still) split
+    """
+    free_slot = select(ItemSlot.item_id, ItemSlot.slot).where(
+        ItemSlot.item_id == item_id, ItemSlot.stock >= max(-delta, 0)
+    ).order_by(func.random()).limit(1).with_for_update(skip_locked=True)
+    result = await session.execute(update(ItemSlot).where(
+        tuple_(ItemSlot.item_id, ItemSlot.slot).in_(free_slot)
+    ).values(stock=ItemSlot.stock + delta).returning(ItemSlot.slot))
+    if result.scalar_one_or_none() is not None:
+        return True
+
+    result = await session.execute(
+        select(ItemSlot.slot, ItemSlot.stock).where(ItemSlot.item_id == item_id).order_by(ItemSlot.slot)
+        .with_for_update()
+    )
+    slots = result.all()
+    if not slots:
+        return False
+
+    # Take as much as possible from every slot, and the rest from the last one
+    deltas = {}
+    remaining = delta
+    for slot, stock in slots[:-1]:
+        if remaining >= 0:
+            break
+        deltas[slot] = -min(stock, -remaining)
+        remaining -= deltas[slot]
+    deltas[slots[-1].slot] = remaining
+    await session.execute(update(ItemSlot).where(
+        ItemSlot.item_id == item_id, ItemSlot.slot.in_(deltas)
+    ).values(stock=case(
+        {slot: ItemSlot.stock + delta for slot, delta in deltas.items()},
+        value=ItemSlot.slot
+    )).execution_options(synchronize_session=False))
+    return True
+
+
+async def update_stock(session: AsyncSession, deltas: Dict[str, int], split: Set[str]) -> bool:
+    """
+    Update the stock of items, the items that are not split in a single UPDATE, whose rows the caller has locked with
+    lock_items, and the split items on their slots in the order of their IDs.
+    :param session: session of the transaction updating the items
+    :param deltas: amount to add to the stock by item ID, negative to subtract
+    :param split: IDs of the split items, see split_items
+    :return: whether all items exist
+    """
+    rows = {item_id: delta for item_id, delta in deltas.items() if item_id not in split}
+    if rows:
+        result = await session.execute(update_stock_statement(rows))
+        if result.rowcount != len(rows):
+            return False
+    for item_id in sorted(split.intersection(deltas)):
+        if not await change_slots(session, item_id, deltas[item_id]):
+            return False
+    return True
+
+
+async def split_item(item_id: str, slots: int) -> Result:
+    """
+    Spread the stock of an item evenly over a number of slots, or merge it back into the item with 1 slot.
+    :param item_id: ID of the item
+    :param slots: number of slots
+    :return: result indicating success, 404 if the item does not exist
+    """
+    if not STOCK_SPLIT_COUNTERS:
+        return Result(HTTPStatus.BAD_REQUEST, "Split counters are disabled, set STOCK_SPLIT_COUNTERS")
+
+    async with Session() as session:
+        item = await session.get(Item, item_id, with_for_update=True)
+        if item is None:
+            return Result(HTTPStatus.NOT_FOUND, "Item not found")
+        result = await session.execute(
+            delete(ItemSlot).where(ItemSlot.item_id == item_id).returning(ItemSlot.stock)
+        )
+        stock = item.stock + sum(result.scalars())
+
+        if slots <= 1:
+            item.stock = stock
+        else:
+            item.stock = 0
+            await session.execute(insert(ItemSlot).values([
+                {"item_id": item_id, "slot": slot, "stock": stock // slots + (slot < stock % slots)}
+                for slot in range(slots)
+            ]))
+        await session.commit()
+    mark_written()
+    return Result(HTTPStatus.OK, f"Stock split over {max(slots, 1)} slots")
+
+
+async def find_item(item_id: str) -> Result:
+    """
+    Get an item with its stock, the stock of a split item is added up from its slots.
+    :param item_id: ID of item
+    :return: result with the item as { id, stock, price }, 404 if it does not exist
+    """
+    item = await read_entity(Item, item_id)
+    if item is None:
+        return Result(HTTPStatus.NOT_FOUND, "Item not found")
+    item = item.as_dict()
+    if STOCK_SPLIT_COUNTERS:
+        async with read_session() as session:
+            result = await session.execute(
+                select(func.coalesce(func.sum(ItemSlot.stock), 0)).where(ItemSlot.item_id == item_id)
+            )
+            item["stock"] += result.scalar_one()
+    return Result(HTTPStatus.OK, item)
+
+
+def hold_statement(hold: Hold):
+    """
+    Create the statement inserting the holds of a reservation, one per item.
+    :param hold: reservation ID and quantities of the items
+    :return: insert statement
+    """
+    expires_at = func.now() + timedelta(seconds=hold.ttl)
+    return insert(Reservation).values([
+        {"id": hold.reservation_id, "item_id": item_id, "quantity": quantity, "expires_at": expires_at}
+        for item_id, quantity in hold.quantities.items()
+    ])
+
+
+def item_quantities(request_body: dict) -> Dict[str, int]:
+    """
+    Read the quantity of every item of a subtractItems or increaseItems request.
+    :param request_body: body with an 'items' object of quantities by item ID, or an 'item_ids' array
+        listing an item once per unit
+    :return: quantity by item ID
+    """
+    if 'items' in request_body:
+        return {item_id: int(quantity) for item_id, quantity in request_body['items'].items()}
+    return Counter(request_body['item_ids'])
+
+
+async def get_item_price(item_id: str) -> Result:
+    """
+    Get price of a certain item.
+    :param item_id: ID of item
+    :return: result with the price of the item, 404 if it does not exist
+    """
+    item = await read_entity(Item, item_id)
+    if item is None:
+        return Result(HTTPStatus.NOT_FOUND, "Item not found")
+    return Result(HTTPStatus.OK, {"price": item.price})
+
+
+async def get_item_prices(item_ids: List[str]) -> Result:
+    """
+    Get prices of multiple items in a single query.
+    Items that do not exist are left out of the result.
+    :param item_ids: IDs of items
+    :return: result with the prices of the items by item ID
+    """
+    # Prices never change after an item is created, so the replica can only miss items that are not replicated yet
+    async with read_session() as session:
+        result = await session.execute(select(Item.id, Item.price).where(Item.id.in_(item_ids)))
+        prices = {item_id: price for item_id, price in result}
+
+    missing = [item_id for item_id in item_ids if item_id not in prices]
+    if missing and replica_engine is not engine:
+        async with Session() as session:
+            result = await session.execute(select(Item.id, Item.price).where(Item.id.in_(missing)))
+            prices.update({item_id: price for item_id, price in result})
+    return Result(HTTPStatus.OK, {"prices": prices})
+
+
+@time(update_stock_db_metric)
+@retry_on_conflict(transaction_retries, "change_stock")
+async def change_stock(deltas: Dict[str, int], message_id: Optional[str] = None,
+                       hold: Optional[Hold] = None) -> Result:
+    """
+    Update the stock in the database
+    If the stock goes below zero, the db will throw an integrity error
+    :param deltas: amount to add to the stock by item ID, negative to subtract
+    :param message_id: ID of the message requesting the update, a message that was processed before is not applied again
+    :param hold: holds to create for the subtracted stock, if it is reserved
+    :return: result indicating success of update
+    """
+    if len(deltas) <= 0:
+        logger.warning("Items subtract call with no items")
+        return Result(HTTPStatus.OK, "No items in request")
+
+    async with Session() as session:
+        if message_id is not None:
+            processed = await get_processed(session, message_id)
+            if processed is not None:
+                logger.debug(f"Message {message_id} was already processed")
+                return Result(HTTPStatus(processed.status), processed.body)
+
+        try:
+            split = await split_items(session, deltas)
+            await lock_items(session, deltas.keys() - split)
+
+            if not await update_stock(session, deltas, split):
+                message, status = "Stock subtracting failed for at least 1 item", HTTPStatus.BAD_REQUEST
+                await session.rollback()
+            else:
+                message, status = "stock subtracted", HTTPStatus.OK
+                if hold is not None:
+                    await session.execute(hold_statement(hold))
+                if message_id is not None:
+                    await record_processed(session, message_id, status, message)
+                await session.commit()
+                mark_written()
+        except sqlalchemy.exc.IntegrityError:
+            await session.rollback()
+            if message_id is not None:
+                processed = await get_processed(session, message_id)
+                if processed is not None:
+                    logger.debug(f"Message {message_id} was processed concurrently")
+                    return Result(HTTPStatus(processed.status), processed.body)
+
+            logger.debug("Violated constraint for item when subtracting items")
+            message, status = "Not enough stock", HTTPStatus.BAD_REQUEST
+
+        # Failures are remembered as well, so a redelivery can not succeed after the order has given up
+        if status != HTTPStatus.OK and message_id is not None:
+            await record_processed(session, message_id, status, message, ignore_duplicate=True)
+            await session.commit()
+
+    logger.debug(f"Update stock result {message}, : {status}")
+    return Result(status, message)
+
+
+@time(update_stock_batch_metric)
+@retry_on_conflict(transaction_retries, "change_stock_batch")
+async def change_stock_batch(updates: List[Tuple[Dict[str, int], Optional[str], Optional[Hold]]]) -> List[Result]:
+    """
+    Apply the stock updates of many orders in a single transaction.
+    Every update runs in its own savepoint, so an update that fails (e.g. not enough stock) does not fail the others.
+    :param updates: deltas, message IDs and holds of the updates, see change_stock
+    :return: result of every update
+    """
+    results: List[Optional[Result]] = [None] * len(updates)
+    failed = []
+    written = set()
+
+    async with Session() as session:
+        processed = await get_processed_many(session, [message_id for _, message_id, _ in updates if message_id])
+        # All items of the batch are locked up front, the savepoints then update rows this transaction holds already
+        item_ids = {item_id for deltas, _, _ in updates for item_id in deltas}
+        split = await split_items(session, item_ids)
+        await lock_items(session, item_ids - split)
+
+        for index, (deltas, message_id, hold) in enumerate(updates):
+            if message_id in processed:
+                results[index] = Result(HTTPStatus(processed[message_id].status), processed[message_id].body)
+                continue
+            if len(deltas) <= 0:
+                results[index] = Result(HTTPStatus.OK, "No items in request")
+                continue
+
+            savepoint = await session.begin_nested()
+            try:
+                if not await update_stock(session, deltas, split):
+                    await savepoint.rollback()
+                    results[index] = Result(HTTPStatus.BAD_REQUEST, "Stock subtracting failed for at least 1 item")
+                    failed.append(index)
+                    continue
+                if hold is not None:
+                    await session.execute(hold_statement(hold))
+                if message_id is not None:
+                    await record_processed(session, message_id, HTTPStatus.OK, "stock subtracted")
+                await savepoint.commit()
+                results[index] = Result(HTTPStatus.OK, "stock subtracted")
+                written.update(deltas)
+            except sqlalchemy.exc.IntegrityError:
+                await savepoint.rollback()
+                stored = await get_processed(session, message_id) if message_id is not None else None
+                if stored is not None:
+                    # Processed concurrently, or earlier in this batch
+                    results[index] = Result(HTTPStatus(stored.status), stored.body)
+                else:
+                    results[index] = Result(HTTPStatus.BAD_REQUEST, "Not enough stock")
+                    failed.append(index)
+
+        # Failures are remembered as well, so a redelivery can not succeed after the order has given up
+        for index in failed:
+            _, message_id, _ = updates[index]
+            if message_id is not None:
+                await record_processed(session, message_id, results[index].status, results[index].body,
+                                       ignore_duplicate=True)
+
+        await session.commit()
+    mark_written()
+
+    logger.debug(f"Update stock batch of {len(updates)} updates, {len(failed)} failed")
+    return results
+
+
+async def decrease_items(quantities: Dict[str, int], message_id: Optional[str] = None) -> Result:
+    """
+    Subtracts the quantity of every item from its stock.
+    :param quantities: quantity by item ID
+    :param message_id: ID of message, used to process a redelivered message only once
+    :return: result indicating success of update
+    """
+    return await change_stock({id_: -quantity for id_, quantity in quantities.items()}, message_id)
+
+
+async def increase_items(quantities: Dict[str, int], message_id: Optional[str] = None) -> Result:
+    """
+    This is a rollback function. Following the SAGA pattern.
+    Increases the stock of every item by its quantity.
+    :param quantities: quantity by item ID
+    :param message_id: ID of message, used to process a redelivered message only once
+    :return: result indicating success of update
+    """
+    return await change_stock(dict(quantities), message_id)
+
+
+async def reserve_items(reservation_id: str, quantities: Dict[str, int], message_id: Optional[str] = None,
+                        ttl: float = RESERVATION_TTL) -> Result:
+    """
+    Subtracts the quantity of every item from its available stock and holds it for a reservation,
+    until the reservation is committed or released, or expires.
+    :param reservation_id: ID of the reservation, e.g. the checkout ID
+    :param quantities: quantity by item ID
+    :param message_id: ID of message, used to process a redelivered message only once
+    :param ttl: seconds until the reservation expires
+    :return: result indicating success of the reservation
+    """
+    return await change_stock({id_: -quantity for id_, quantity in quantities.items()}, message_id,
+                              Hold(reservation_id, quantities, ttl))
+
+
+async def commit_reservation(reservation_id: str) -> Result:
+    """
+    Finalize a reservation, its stock stays subtracted. Only touches the holds, not the items.
+    A reservation with an expired hold whose stock was returned is not committed, its other holds are released.
+    The holds are locked, and the sweeper skips locked holds, so a hold is either committed or returned.
+    :param reservation_id: ID of the reservation
+    :return: result indicating success, 404 if the reservation is not held (anymore), 410 if it expired
+    """
+    async with Session() as session:
+        result = await session.execute(select(Reservation.returned).where(
+            Reservation.id == reservation_id, ~Reservation.released
+        ).with_for_update())
+        returned = result.scalars().all()
+        if not returned:
+            logger.debug(f"Reservation {reservation_id} is not held, it was committed or released before")
+            return Result(HTTPStatus.NOT_FOUND, "Reservation not found")
+
+        if any(returned):
+            await session.execute(update(Reservation).where(
+                Reservation.id == reservation_id, ~Reservation.released
+            ).values(released=True))
+            await session.commit()
+            reservation_commits_expired.inc()
+            logger.warning(f"Reservation {reservation_id} expired before it was committed")
+            return Result(HTTPStatus.GONE, "Reservation expired")
+
+        await session.execute(delete(Reservation).where(Reservation.id == reservation_id))
+        await session.commit()
+    return Result(HTTPStatus.OK, "Reservation committed")
+
+
+async def release_reservation(reservation_id: str) -> Result:
+    """
+    This is a rollback function. Following the SAGA pattern.
+    Release a reservation, the sweeper returns its stock to the items with the stock of other released holds.
+    Releasing an expired reservation only drops its holds, their stock was returned already.
+    Only touches the holds, not the items.
+    :param reservation_id: ID of the reservation
+    :return: result indicating success, 404 if the reservation is not held (anymore)
+    """
+    async with Session() as session:
+        result = await session.execute(update(Reservation).where(
+            Reservation.id == reservation_id, ~Reservation.released
+        ).values(released=True))
+        await session.commit()
+
+    if result.rowcount == 0:
+        logger.debug(f"Reservation {reservation_id} is not held, it was committed or released before")
+        return Result(HTTPStatus.NOT_FOUND, "Reservation not found")
+    return Result(HTTPStatus.OK, "Reservation released")
+
+
+@retry_on_conflict(transaction_retries, "return_held_stock")
+async def return_held_stock() -> int:
+    """
+    Return the stock of up to RESERVATION_SWEEP_BATCH released or expired holds to the items,
+    with one update of every item for all its holds.
+    Released holds are deleted, expired holds are kept as returned so a late commit fails, see Reservation.
+    Holds locked by another sweeper or by a commit at the same time are skipped.
+    :return: number of holds returned
+    """
+    returnable = select(Reservation.id, Reservation.item_id).where(
+        ~Reservation.returned, or_(Reservation.released, Reservation.expires_at < func.now())
+    ).limit(RESERVATION_SWEEP_BATCH).with_for_update(skip_locked=True)
+
+    quantities = Counter()
+    async with Session() as session:
+        result = await session.execute(update(Reservation).where(
+            tuple_(Reservation.id, Reservation.item_id).in_(returnable)
+        ).values(returned=True).returning(Reservation.item_id, Reservation.quantity))
+        holds = result.all()
+        for item_id, quantity in holds:
+            quantities[item_id] += quantity
+
+        if quantities:
+            split = await split_items(session, quantities)
+            await lock_items(session, quantities.keys() - split)
+            await update_stock(session, quantities, split)
+
+        await session.execute(delete(Reservation).where(
+            Reservation.returned,
+            or_(Reservation.released,
+                Reservation.expires_at < func.now() - timedelta(seconds=RESERVATION_EXPIRED_RETENTION))
+        ).execution_options(synchronize_session=False))
+        await session.commit()
+    return len(holds)
+
+
+async def sweep_reservations():
+    """
+    Periodically return the stock of released and expired holds to the items.
+    """
+    while True:
+        try:
+            returned = await return_held_stock()
+            if returned:
+                holds_returned.inc(returned)
+                logger.debug(f"Returned the stock of {returned} holds")
+            # Keep sweeping without waiting while there is a backlog
+            if returned >= RESERVATION_SWEEP_BATCH:
+                continue
+        except Exception:
+            logger.exception("Returning the stock of released and expired holds failed")
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL)
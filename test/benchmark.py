@@ -0,0 +1,70 @@
+"""
+Throughput benchmark for the request rate of the services.
+
+Run it against a deployment with a single uvicorn worker per service to get the requests/sec per worker,
+once before and once after a change, and compare the numbers.
+
+usage: python benchmark.py [duration in seconds] [number of concurrent clients]
+"""
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import utils as tu
+
+
+def populate():
+    """
+    Create a user, an item and an order containing that item to run the requests against.
+    :return: tuple of user ID, item ID and order ID
+    """
+    user_id = tu.create_user()['user_id']
+    tu.add_credit_to_user(user_id, 1_000_000)
+
+    item_id = tu.create_item(1)['item_id']
+    tu.add_stock(item_id, 1_000_000)
+
+    order_id = tu.create_order(user_id)['order_id']
+    tu.add_item_to_order(order_id, item_id)
+    return user_id, item_id, order_id
+
+
+def client(deadline, user_id, item_id, order_id):
+    """
+    Keep sending a mix of reads and writes to all services until the deadline.
+    :return: counter of successful requests per endpoint
+    """
+    requests = {
+        "find_user": lambda: tu.find_user(user_id),
+        "add_funds": lambda: tu.add_credit_to_user(user_id, 1),
+        "find_item": lambda: tu.find_item(item_id),
+        "add_stock": lambda: tu.add_stock(item_id, 1),
+        "find_order": lambda: tu.find_order(order_id),
+    }
+    done = Counter()
+    while time.monotonic() < deadline:
+        for name, request in requests.items():
+            request()
+            done[name] += 1
+    return done
+
+
+def main(duration=30, concurrency=64):
+    user_id, item_id, order_id = populate()
+
+    start = time.monotonic()
+    deadline = start + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(client, deadline, user_id, item_id, order_id) for _ in range(concurrency)]
+        total = sum((future.result() for future in futures), Counter())
+    elapsed = time.monotonic() - start
+
+    print(f"{concurrency} clients, {elapsed:.1f}s")
+    for name, count in sorted(total.items()):
+        print(f"{name:>12}: {count / elapsed:8.1f} req/s")
+    print(f"{'total':>12}: {sum(total.values()) / elapsed:8.1f} req/s")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
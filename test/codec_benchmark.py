@@ -0,0 +1,48 @@
+"""
+Microbenchmark of the message codecs.
+
+Measures the time to encode and decode the bodies of the subtractItems and getPrices messages and their replies,
+and their size on the wire, for carts of increasing size.
+
+usage: python codec_benchmark.py [largest cart] [repetitions]
+"""
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'order'))
+from codec import CODECS  # noqa: E402
+
+
+def payloads(cart_size):
+    """
+    Build the payloads of a checkout of a cart with cart_size distinct items.
+    :return: payloads by message name
+    """
+    item_ids = [str(uuid.uuid4()) for _ in range(cart_size)]
+    return {
+        "subtractItems": {"items": {item_id: 1 + i % 3 for i, item_id in enumerate(item_ids)}},
+        "getPrices": {"item_ids": item_ids},
+        "getPrices reply": {"prices": {item_id: 1 + i % 100 for i, item_id in enumerate(item_ids)}},
+        "pay": {"user_id": str(uuid.uuid4()), "order_id": str(uuid.uuid4()), "total_cost": 100 * cart_size},
+    }
+
+
+def main(largest_cart=1000, repetitions=1000):
+    print(f"{'message':<16} {'items':>6} {'codec':<8} {'bytes':>8} {'encode us':>10} {'decode us':>10}")
+    cart_size = 1
+    while cart_size <= largest_cart:
+        for name, payload in payloads(cart_size).items():
+            for codec in CODECS.values():
+                body = codec.encode(payload)
+                assert codec.decode(body) == payload
+                encode = timeit.timeit(lambda: codec.encode(payload), number=repetitions) / repetitions
+                decode = timeit.timeit(lambda: codec.decode(body), number=repetitions) / repetitions
+                print(f"{name:<16} {cart_size:>6} {codec.name:<8} {len(body):>8} "
+                      f"{encode * 1e6:>10.2f} {decode * 1e6:>10.2f}")
+        cart_size *= 10
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
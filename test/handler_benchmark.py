@@ -0,0 +1,61 @@
+"""
+Microbenchmark of the per-message overhead of the consumers.
+
+Compares the CPU time of wrapping a handler in a Quart app context and building a Response to read the reply from,
+as the consumers did, with returning a result of the service layer. The database work of a message is the same for
+both and is left out.
+
+usage: python handler_benchmark.py [number of messages]
+"""
+import asyncio
+import sys
+import time
+from dataclasses import dataclass
+from http import HTTPStatus
+from typing import Any
+
+from quart import Quart, make_response
+
+
+@dataclass
+class Result:
+    status: HTTPStatus
+    body: Any
+
+
+app = Quart('handler-benchmark')
+
+
+async def with_response():
+    async with app.app_context():
+        response = await make_response("stock subtracted", HTTPStatus.OK)
+    return response.status_code, (await response.get_data()).decode()
+
+
+async def with_result():
+    result = Result(HTTPStatus.OK, "stock subtracted")
+    return int(result.status), result.body
+
+
+async def measure(handler, n):
+    """
+    Run a handler n times.
+    :return: CPU seconds per message
+    """
+    start = time.process_time()
+    for _ in range(n):
+        await handler()
+    return (time.process_time() - start) / n
+
+
+async def main(n=100_000):
+    assert await with_response() == await with_result()
+    response = await measure(with_response, n)
+    result = await measure(with_result, n)
+    print(f"app context and Response: {response * 1e6:.2f}us CPU per message")
+    print(f"service layer result:     {result * 1e6:.2f}us CPU per message")
+    print(f"saved:                    {(response - result) * 1e6:.2f}us CPU per message")
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -0,0 +1,120 @@
+"""
+Benchmark of the checkout throughput on a single popular item, with its stock in one row or split over K slots.
+
+For every number of slots, clears the tables, creates one item, splits its stock over the slots and checks out
+orders that all contain this item with a fixed number of concurrent clients. Reports the checkouts per second and
+their p50/p99 latency, and checks that the stock sold matches the paid checkouts.
+
+The stock service (and its queue consumers) have to run with STOCK_SPLIT_COUNTERS=true, e.g. with
+`docker-compose up --build` and `python hot_item_benchmark.py --slots 1,4,16 --orders 5000 --concurrency 128`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import aiohttp
+
+
+async def request(session: aiohttp.ClientSession, method, url):
+    """
+    Send a request to the gateway.
+    :return: status code and body of the response, status 0 if the request failed
+    """
+    try:
+        async with session.request(method, url) as response:
+            return response.status, await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return 0, ""
+
+
+async def populate(session: aiohttp.ClientSession, args, slots: int):
+    """
+    Create the users, the item split over the slots, and the orders, which each contain the item twice.
+    """
+    url = args.url.rstrip('/')
+    for method, path in (('DELETE', '/orders/clear_tables'), ('DELETE', '/stock/clear_tables'),
+                         ('DELETE', '/payment/clear_tables'),
+                         ('POST', f'/payment/batch_init/{args.orders}/{args.price * 2}'),
+                         ('POST', f'/stock/batch_init/1/{args.stock}/{args.price}'),
+                         ('POST', f'/stock/split/0/{slots}'),
+                         ('POST', f'/orders/batch_init/{args.orders}/1/{args.orders}/{args.price}')):
+        status, body = await request(session, method, f"{url}{path}")
+        if status != 200:
+            raise RuntimeError(f"{path} failed with {status}: {body}")
+
+
+async def checkout_all(session: aiohttp.ClientSession, args):
+    """
+    Check out all orders with at most the configured number of concurrent clients.
+    :return: elapsed seconds, latencies of the checkouts and the number of paid checkouts
+    """
+    url = args.url.rstrip('/')
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    paid = 0
+
+    async def checkout(order_id):
+        nonlocal paid
+        async with semaphore:
+            start = time.perf_counter()
+            status, _ = await request(session, 'POST', f"{url}/orders/checkout/{order_id}")
+            latencies.append(time.perf_counter() - start)
+            paid += status == 200
+
+    start = time.monotonic()
+    await asyncio.gather(*(checkout(order_id) for order_id in range(args.orders)))
+    return time.monotonic() - start, latencies, paid
+
+
+async def main(args):
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    results = {}
+    consistent = True
+    print(f"{args.orders} checkouts of one item, {args.concurrency} clients")
+    print(f"{'slots':>6} {'checkouts/s':>12} {'p50 ms':>8} {'p99 ms':>8} {'paid':>6} {'stock':>7}")
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        for slots in map(int, args.slots.split(',')):
+            await populate(session, args, slots)
+            elapsed, latencies, paid = await checkout_all(session, args)
+
+            # Compensations of failed checkouts are processed asynchronously
+            await asyncio.sleep(args.settle)
+            _, body = await request(session, 'GET', f"{args.url.rstrip('/')}/stock/find/0")
+            stock = json.loads(body)['stock']
+            consistent &= stock == args.stock - 2 * paid
+
+            quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+            results[slots] = {
+                "throughput": len(latencies) / elapsed,
+                "p50": quantiles[49] * 1000,
+                "p99": quantiles[98] * 1000,
+                "paid": paid,
+                "stock": stock,
+            }
+            r = results[slots]
+            print(f"{slots:>6} {r['throughput']:>12.1f} {r['p50']:>8.1f} {r['p99']:>8.1f} {paid:>6} {stock:>7}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if consistent else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default=os.environ.get('GATEWAY_URL', 'http://127.0.0.1:8000'),
+                        help="URL of the gateway")
+    parser.add_argument('--slots', default="1,2,4,8,16", help="comma separated numbers of slots to compare")
+    parser.add_argument('--orders', type=int, default=2000, help="orders checked out per number of slots")
+    parser.add_argument('--stock', type=int, default=1_000_000, help="stock of the item")
+    parser.add_argument('--price', type=int, default=1, help="price of the item")
+    parser.add_argument('--concurrency', type=int, default=64, help="concurrent clients")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds before a request fails")
+    parser.add_argument('--settle', type=float, default=5, help="seconds to wait before reading the stock")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    sys.exit(asyncio.run(main(parser.parse_args())))
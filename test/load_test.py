@@ -0,0 +1,325 @@
+"""
+Load test of the three services through the gateway.
+
+Populates users, items and orders, then drives a weighted mix of `create`, `addItem`, `checkout` and `find`
+requests with a fixed number of concurrent clients for a fixed duration. Reports the throughput and the
+p50/p95/p99 latency per endpoint, and afterwards checks that the system is consistent:
+the credit spent by all users equals the value of the stock sold, and equals the cost of the orders
+that were checked out successfully.
+
+Run it against the local stack with `docker-compose up --build` and e.g.
+`python load_test.py --duration 60 --concurrency 128 --mix find=40,addItem=30,checkout=20,create=10`.
+The exit code is 1 if the consistency check fails, so it can be used to gate regressions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import aiohttp
+
+ENDPOINTS = ("create", "addItem", "checkout", "find")
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """
+    Parse the request mix.
+    :param mix: comma separated endpoint=weight pairs
+    :return: weight by endpoint
+    """
+    weights = {}
+    for pair in filter(None, mix.split(',')):
+        endpoint, weight = pair.split('=')
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {endpoint}, expected one of {ENDPOINTS}")
+        weights[endpoint] = int(weight)
+    return weights
+
+
+class LoadTest:
+    """
+    State of one load test run: the created entities and the measured latencies.
+    Every order is used by at most one write request at a time, so the cost of an order that is checked out
+    is known exactly when checking consistency.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, args) -> None:
+        self.session = session
+        self.url = args.url.rstrip('/')
+        self.args = args
+        self.user_ids: List[str] = []
+        self.prices: Dict[str, int] = {}
+        self.order_ids: List[str] = []
+        self.open_orders: List[str] = []
+        self.paid_orders: List[str] = []
+        # Orders whose checkout failed without a response, they may or may not have been paid
+        self.unknown_orders: List[str] = []
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def request(self, method, path, endpoint=None):
+        """
+        Send a request to the gateway, measuring its latency if an endpoint name is given.
+        :return: status code and body of the response, status 0 if the request failed
+        """
+        start = time.perf_counter()
+        try:
+            async with self.session.request(method, f"{self.url}{path}") as response:
+                body = await response.text()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            status, body = 0, ""
+        if endpoint is not None:
+            self.latencies[endpoint].append(time.perf_counter() - start)
+            self.statuses[endpoint][status] += 1
+            if status == 0 or status >= 500:
+                self.errors[endpoint] += 1
+        return status, body
+
+    async def gather_limited(self, coroutines):
+        """
+        Run coroutines with at most the configured concurrency at a time.
+        """
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*(limited(coroutine) for coroutine in coroutines))
+
+    async def create_user(self):
+        _, body = await self.request('POST', '/payment/create_user')
+        user_id = json.loads(body)['user_id']
+        await self.request('POST', f'/payment/add_funds/{user_id}/{self.args.credit}')
+        self.user_ids.append(user_id)
+
+    async def create_item(self):
+        price = random.randint(1, self.args.max_price)
+        _, body = await self.request('POST', f'/stock/item/create/{price}')
+        item_id = json.loads(body)['item_id']
+        await self.request('POST', f'/stock/add/{item_id}/{self.args.stock}')
+        self.prices[item_id] = price
+
+    async def create_order(self, endpoint=None):
+        status, body = await self.request('POST', f'/orders/create/{random.choice(self.user_ids)}', endpoint)
+        if status == 200:
+            order_id = json.loads(body)['order_id']
+            self.order_ids.append(order_id)
+            return order_id
+        return None
+
+    async def populate_order(self):
+        order_id = await self.create_order()
+        await self.request('POST', f'/orders/addItem/{order_id}/{random.choice(list(self.prices))}')
+        self.open_orders.append(order_id)
+
+    async def populate(self):
+        """
+        Create the users and items, then the orders with one item each.
+        """
+        if self.args.batch_init:
+            return await self.batch_init()
+        await self.gather_limited([self.create_user() for _ in range(self.args.users)])
+        await self.gather_limited([self.create_item() for _ in range(self.args.items)])
+        await self.gather_limited([self.populate_order() for _ in range(self.args.orders)])
+
+    async def batch_init(self):
+        """
+        Create the users, items and orders with the batch_init endpoints, every item has the maximum price and
+        every order two items. Run with --clear when reusing the database, as the orders keep their IDs.
+        """
+        args = self.args
+        for path in (f'/payment/batch_init/{args.users}/{args.credit}',
+                     f'/stock/batch_init/{args.items}/{args.stock}/{args.max_price}',
+                     f'/orders/batch_init/{args.orders}/{args.items}/{args.users}/{args.max_price}'):
+            status, body = await self.request('POST', path)
+            if status != 200:
+                raise RuntimeError(f"{path} failed with {status}: {body}")
+        self.user_ids = [str(i) for i in range(args.users)]
+        self.prices = {str(i): args.max_price for i in range(args.items)}
+        self.order_ids = [str(i) for i in range(args.orders)]
+        self.open_orders = list(self.order_ids)
+
+    def take_open_order(self):
+        """
+        Take an unpaid order that no other client is writing to, the caller has to give it back.
+        """
+        if not self.open_orders:
+            return None
+        index = random.randrange(len(self.open_orders))
+        self.open_orders[index], self.open_orders[-1] = self.open_orders[-1], self.open_orders[index]
+        return self.open_orders.pop()
+
+    async def run_create(self):
+        order_id = await self.create_order("create")
+        if order_id is not None:
+            self.open_orders.append(order_id)
+
+    async def run_add_item(self):
+        order_id = self.take_open_order()
+        if order_id is None:
+            return await self.run_create()
+        try:
+            await self.request('POST', f'/orders/addItem/{order_id}/{random.choice(list(self.prices))}', "addItem")
+        finally:
+            self.open_orders.append(order_id)
+
+    async def run_checkout(self):
+        order_id = self.take_open_order()
+        if order_id is None:
+            return await self.run_create()
+        status, _ = await self.request('POST', f'/orders/checkout/{order_id}', "checkout")
+        if status == 200:
+            self.paid_orders.append(order_id)
+        elif status == 0 or status >= 500:
+            self.unknown_orders.append(order_id)
+        else:
+            self.open_orders.append(order_id)
+
+    async def run_find(self):
+        await self.request('GET', f'/orders/find/{random.choice(self.order_ids)}', "find")
+
+    async def client(self, deadline, weights: Dict[str, int]):
+        """
+        Keep sending requests of the mix until the deadline.
+        """
+        runs = {"create": self.run_create, "addItem": self.run_add_item,
+                "checkout": self.run_checkout, "find": self.run_find}
+        endpoints = list(weights)
+        while time.monotonic() < deadline:
+            await runs[random.choices(endpoints, weights=list(weights.values()))[0]]()
+
+    async def load(self, weights: Dict[str, int]):
+        """
+        Run the clients for the configured duration.
+        :return: elapsed seconds
+        """
+        start = time.monotonic()
+        deadline = start + self.args.duration
+        await asyncio.gather(*(self.client(deadline, weights) for _ in range(self.args.concurrency)))
+        return time.monotonic() - start
+
+    async def check_consistency(self):
+        """
+        Compare the credit spent by the users with the value of the stock sold and the cost of the paid orders.
+        :return: dictionary with the totals and whether they match
+        """
+        async def find(path):
+            status, body = await self.request('GET', path)
+            return json.loads(body) if status == 200 else None
+
+        users = await self.gather_limited([find(f'/payment/find_user/{user_id}') for user_id in self.user_ids])
+        items = await self.gather_limited([find(f'/stock/find/{item_id}') for item_id in self.prices])
+        orders = await self.gather_limited([find(f'/orders/find/{order_id}') for order_id in self.paid_orders])
+        unknown = await self.gather_limited([find(f'/orders/find/{order_id}') for order_id in self.unknown_orders])
+
+        missing = sum(entity is None for entity in users + items + orders)
+        users, items, orders = (list(filter(None, entities)) for entities in (users, items, orders))
+
+        credit_spent = sum(self.args.credit - user['credit'] for user in users)
+        stock_sold = sum((self.args.stock - item['stock']) * item['price'] for item in items)
+        paid_cost = sum(order['total_cost'] for order in orders + list(filter(None, unknown)) if order['paid'])
+        unpaid = sum(not order['paid'] for order in orders)
+        return {
+            "credit_spent": credit_spent,
+            "stock_sold": stock_sold,
+            "paid_order_cost": paid_cost,
+            "paid_orders": len(orders),
+            "unknown_orders_paid": sum(bool(order and order['paid']) for order in unknown),
+            "paid_orders_not_marked_paid": unpaid,
+            "not_found": missing,
+            "consistent": abs(credit_spent - stock_sold) < 1e-6 and abs(credit_spent - paid_cost) < 1e-6
+            and unpaid == 0 and missing == 0,
+        }
+
+
+def report(test: LoadTest, elapsed: float):
+    """
+    Print the throughput and latency percentiles per endpoint.
+    :return: dictionary with the results per endpoint
+    """
+    results = {}
+    print(f"{test.args.concurrency} clients, {elapsed:.1f}s")
+    print(f"{'endpoint':>10} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}"
+          f"  statuses")
+    for endpoint in ENDPOINTS:
+        latencies = test.latencies.get(endpoint)
+        if not latencies:
+            continue
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        results[endpoint] = {
+            "requests": len(latencies),
+            "throughput": len(latencies) / elapsed,
+            "p50": quantiles[49] * 1000,
+            "p95": quantiles[94] * 1000,
+            "p99": quantiles[98] * 1000,
+            "errors": test.errors[endpoint],
+            "statuses": dict(test.statuses[endpoint]),
+        }
+        r = results[endpoint]
+        print(f"{endpoint:>10} {r['requests']:>9} {r['throughput']:>9.1f} {r['p50']:>8.1f} {r['p95']:>8.1f} "
+              f"{r['p99']:>8.1f} {r['errors']:>7}  {r['statuses']}")
+    total = sum(len(latencies) for latencies in test.latencies.values())
+    print(f"{'total':>10} {total:>9} {total / elapsed:>9.1f}")
+    return results
+
+
+async def main(args):
+    weights = parse_mix(args.mix)
+    random.seed(args.seed)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        test = LoadTest(session, args)
+        if args.clear:
+            for path in ("orders", "stock", "payment"):
+                await test.request('DELETE', f'/{path}/clear_tables')
+
+        start = time.monotonic()
+        await test.populate()
+        print(f"Populated {len(test.user_ids)} users, {len(test.prices)} items and {len(test.order_ids)} orders "
+              f"in {time.monotonic() - start:.1f}s")
+
+        elapsed = await test.load(weights)
+        results = report(test, elapsed)
+
+        # Compensating messages of failed checkouts are processed asynchronously
+        await asyncio.sleep(args.settle)
+        consistency = await test.check_consistency()
+        print(f"Consistency: {consistency}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"elapsed": elapsed, "endpoints": results, "consistency": consistency}, f, indent=2)
+    return 0 if consistency["consistent"] else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default=os.environ.get('GATEWAY_URL', 'http://127.0.0.1:8000'),
+                        help="URL of the gateway")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--orders', type=int, default=1000, help="orders created before the load starts")
+    parser.add_argument('--credit', type=int, default=1000, help="credit of every user")
+    parser.add_argument('--stock', type=int, default=100, help="stock of every item")
+    parser.add_argument('--max-price', type=int, default=10, help="prices are drawn from 1 to this value")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run the load")
+    parser.add_argument('--concurrency', type=int, default=64, help="concurrent clients")
+    parser.add_argument('--mix', default="find=40,addItem=30,checkout=20,create=10",
+                        help="weights of the endpoints")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds before a request fails")
+    parser.add_argument('--settle', type=float, default=5, help="seconds to wait before checking consistency")
+    parser.add_argument('--seed', type=int, default=None, help="seed of the random choices")
+    parser.add_argument('--clear', action='store_true', help="clear all tables before populating")
+    parser.add_argument('--batch-init', action='store_true', help="populate with the batch_init endpoints")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    sys.exit(asyncio.run(main(parser.parse_args())))
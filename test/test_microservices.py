@@ -187,7 +187,6 @@ class TestMicroservices(unittest.TestCase):
         add_item_response = tu.add_item_to_order(order_id2, item_id1)
         self.assertTrue(tu.status_code_is_success(add_item_response))
 
-
         # Stock of item1 should be 1 before the two order checkouts and 1 after the checkouts
         stock: int = tu.find_item(item_id1)['stock']
         self.assertEqual(stock, 1)
@@ -202,21 +201,66 @@ class TestMicroservices(unittest.TestCase):
         credit_after_payment2: int = tu.find_user(user_id2)['credit']
         self.assertEqual(credit_after_payment + credit_after_payment2, 25)
 
+    def test_async_checkout(self):
+        user_id: str = tu.create_user()['user_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 10)))
+
+        item_id: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 1)))
+
+        order_id: str = tu.create_order(user_id)['order_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id)))
+
+        # Test /orders/checkout/<order_id>?async=true
+        checkout_response = tu.checkout_order_async(order_id)
+        self.assertEqual(checkout_response.status_code, 202)
+
+        # Test /orders/checkout_status/<order_id>
+        status: dict = tu.checkout_status(order_id)
+        for _ in range(50):
+            if status['status'] in ('completed', 'failed'):
+                break
+            time.sleep(0.2)
+            status = tu.checkout_status(order_id)
+        self.assertEqual(status['status'], 'completed')
+        self.assertTrue(status['paid'])
+
+        self.assertTrue(tu.find_order(order_id)['paid'])
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+        self.assertEqual(tu.find_user(user_id)['credit'], 5)
+
+    def test_batch_init(self):
+        # Test the /batch_init endpoints, the created entities have the IDs 0 to n - 1.
+        # Existing items keep their price, so start from empty tables
+        tu.clear_tables()
+        self.assertTrue(tu.status_code_is_success(tu.batch_init_items(10, 100, 1)))
+        self.assertTrue(tu.status_code_is_success(tu.batch_init_users(10, 50)))
+        self.assertTrue(tu.status_code_is_success(tu.batch_init_orders(10, 10, 5, 1)))
+
+        item: dict = tu.find_item('9')
+        self.assertEqual(item['price'], 1)
+        self.assertEqual(item['stock'], 100)
+
+        user: dict = tu.find_user('9')
+        self.assertEqual(user['credit'], 50)
+
+        order: dict = tu.find_order('9')
+        self.assertEqual(order['user_id'], '4')
+        self.assertEqual(sorted(order['items']), ['0', '9'])
+        self.assertEqual(order['total_cost'], 2)
+        self.assertFalse(order['paid'])
+
 
 async def async_reqs(n, user_id):
     import asyncio
     loop = asyncio.get_event_loop()
-    for _ in range(n):
-        fut = loop.run_in_executor(None, tu.add_credit_to_user, user_id, 10)
-    await fut
+    await asyncio.gather(*(loop.run_in_executor(None, tu.add_credit_to_user, user_id, 10) for _ in range(n)))
 
 
 async def async_order(order_ids):
     import asyncio
     loop = asyncio.get_event_loop()
-    for order_id in order_ids:
-        fut = loop.run_in_executor(None, tu.checkout_order, order_id)
-    await fut
+    await asyncio.gather(*(loop.run_in_executor(None, tu.checkout_order, order_id) for order_id in order_ids))
 
 
 if __name__ == '__main__':
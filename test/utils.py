@@ -1,7 +1,9 @@
+import os
+
 import requests
 
-# ORDER_URL = STOCK_URL = PAYMENT_URL = "http://127.0.0.1:8000"  # localhost
-ORDER_URL = STOCK_URL = PAYMENT_URL = "http://34.147.9.239"  # kubernetes GCP cluster
+# e.g. GATEWAY_URL=http://127.0.0.1:8000 for the docker-compose gateway
+ORDER_URL = STOCK_URL = PAYMENT_URL = os.environ.get('GATEWAY_URL', "http://34.147.9.239")  # kubernetes GCP cluster
 
 
 def clear_tables():
@@ -21,6 +23,10 @@ def create_item(price: float) -> dict:
     return requests.post(f"{STOCK_URL}/stock/item/create/{price}").json()
 
 
+def batch_init_items(n: int, starting_stock: int, item_price: float) -> int:
+    return requests.post(f"{STOCK_URL}/stock/batch_init/{n}/{starting_stock}/{item_price}").status_code
+
+
 def find_item(item_id: str) -> dict:
     return requests.get(f"{STOCK_URL}/stock/find/{item_id}").json()
 
@@ -44,6 +50,10 @@ def create_user() -> dict:
     return requests.post(f"{PAYMENT_URL}/payment/create_user").json()
 
 
+def batch_init_users(n: int, starting_money: float) -> int:
+    return requests.post(f"{PAYMENT_URL}/payment/batch_init/{n}/{starting_money}").status_code
+
+
 def find_user(user_id: str) -> dict:
     return requests.get(f"{PAYMENT_URL}/payment/find_user/{user_id}").json()
 
@@ -59,6 +69,10 @@ def create_order(user_id: str) -> dict:
     return requests.post(f"{ORDER_URL}/orders/create/{user_id}").json()
 
 
+def batch_init_orders(n: int, n_items: int, n_users: int, item_price: float) -> int:
+    return requests.post(f"{ORDER_URL}/orders/batch_init/{n}/{n_items}/{n_users}/{item_price}").status_code
+
+
 def add_item_to_order(order_id: str, item_id: str) -> int:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}").status_code
 
@@ -71,6 +85,14 @@ def checkout_order(order_id: str) -> requests.Response:
     return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}")
 
 
+def checkout_order_async(order_id: str) -> requests.Response:
+    return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}", params={"async": "true"})
+
+
+def checkout_status(order_id: str) -> dict:
+    return requests.get(f"{ORDER_URL}/orders/checkout_status/{order_id}").json()
+
+
 ########################################################################################################################
 #   STATUS CHECKS
 ########################################################################################################################